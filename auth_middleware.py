@@ -1,17 +1,76 @@
 from db import db
 from functools import wraps
+from collections import namedtuple
+import hashlib
+import time
 import jwt
 from flask import request, abort, current_app, jsonify
+from cache import MemoryBackend
 from models import User
 
+# The authenticated user passed to protected handlers. Handlers only need the id and username,
+# so they get this lightweight principal instead of a full User row.
+Principal = namedtuple("Principal", ["id", "username"])
+
+# Verified principals keyed by the SHA-256 digest of their token. Each entry expires together with
+# its token, so a cached token is never accepted past its exp. Repeated requests with the same token
+# skip the signature check and the user lookup.
+principal_cache = MemoryBackend(max_entries=10000)
+
+# Digests of tokens revoked in this process (e.g. on logout), mapped to the token's exp.
+# Entries are dropped once the token would have expired anyway, when the next token is revoked.
+revoked_tokens = {}
+
+# Extra revocation checks, e.g. a shared blacklist. Each is called with the token digest
+# on every request and returns True if the token must be rejected.
+revocation_checks = []
+
+
+def token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+# Registers a revocation check. Can be used as a decorator.
+def register_revocation_check(check):
+    revocation_checks.append(check)
+    return check
+
+
+# Blacklists a token and drops it from the principal cache. Also prunes revoked tokens that have
+# expired, so the blacklist only holds tokens that would still be accepted.
+def revoke_token(token):
+    digest = token_digest(token)
+    try:
+        exp = jwt.decode(token, options={"verify_signature": False}).get("exp", float("inf"))
+    except jwt.InvalidTokenError:
+        exp = float("inf")
+    now = time.time()
+    for revoked_digest, revoked_exp in list(revoked_tokens.items()):
+        if revoked_exp < now:
+            del revoked_tokens[revoked_digest]
+    revoked_tokens[digest] = exp
+    principal_cache.delete(digest)
+
+
+# Called on every authenticated request, so it is a dict lookup plus the registered checks. An expired
+# token still in revoked_tokens is rejected by the signature check anyway.
+def is_revoked(digest):
+    return digest in revoked_tokens or any(check(digest) for check in revocation_checks)
+
+
+# Returns the bearer token of the current request, or None.
+def request_token():
+    if "Authorization" in request.headers:
+        auth_header = request.headers["Authorization"]
+        if auth_header.startswith("Bearer "):
+            return auth_header.split(" ")[1]
+    return None
+
+
 def token_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if "Authorization" in request.headers:
-            auth_header = request.headers["Authorization"]
-            if auth_header.startswith("Bearer "):
-                token = auth_header.split(" ")[1]
+        token = request_token()
         if not token:
             return jsonify({
                 "message": "Authentication Token is missing!",
@@ -19,14 +78,27 @@ def token_required(f):
                 "error": "Unauthorized"
             }), 401
         try:
-            data = jwt.decode(token, current_app.config["SECRET_KEY"], algorithms=["HS256"])
-            current_user = db.session.get(User, data["user_id"])
-            if current_user is None:
+            digest = token_digest(token)
+            if is_revoked(digest):
                 return jsonify({
-                    "message": "Invalid Authentication token!",
+                    "message": "Authentication Token has been revoked!",
                     "data": None,
                     "error": "Unauthorized"
                 }), 401
+
+            current_user = principal_cache.get(digest)
+            if current_user is None:
+                data = jwt.decode(token, current_app.config["SECRET_KEY"], algorithms=["HS256"])
+                user = db.session.get(User, data["user_id"])
+                if user is None:
+                    return jsonify({
+                        "message": "Invalid Authentication token!",
+                        "data": None,
+                        "error": "Unauthorized"
+                    }), 401
+                current_user = Principal(user.id, user.username)
+                if "exp" in data and data["exp"] > time.time():
+                    principal_cache.set(digest, current_user, data["exp"] - time.time())
         except jwt.ExpiredSignatureError:
             return jsonify({
                 "message": "Authentication Token has expired!",
@@ -48,4 +120,4 @@ def token_required(f):
 
         return f(current_user, *args, **kwargs)
 
-    return decorated
\ No newline at end of file
+    return decorated
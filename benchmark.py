@@ -0,0 +1,804 @@
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from flask import Flask, jsonify
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import WSGIRequestHandler, make_server
+from sqlalchemy import func, insert, literal, select, union_all, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from datagen import PASSWORD, WORDS, generate, generate_clubs, random_text, vocabulary
+from db import SQLITE_PROFILES, busy_stats, db, init_db_engine, retry_on_busy
+from models import *
+import search
+from favorites import add_favorite, reconcile_favorites, remove_favorite
+from passwords import hasher
+from queries import club_comments, clubs_query, comments_query
+from mutations import commit_club_writes, resolve_tags, update_club, write_club_batch
+from tag_index import filter_club_ids, tag_index
+from tag_stats import check_tag_stats, rebuild_tag_stats
+from versions import bump, create_versions
+
+# Benchmarks for the performance sensitive paths of the API.
+# Each benchmark runs against its own temporary SQLite database filled with synthetic data,
+# so it never touches clubreview.db. Run one with e.g. `python benchmark.py search --clubs 100000`.
+
+# Creates a Flask app bound to a temporary SQLite file, with all tables created.
+# profile is one of the SQLite engine profiles in db.py.
+def bench_app(path, profile="default"):
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{path}"
+    app.config["DB_PROFILE"] = profile
+    init_db_engine(app)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+# Runs fn repeat times and returns the durations in milliseconds.
+def timed(fn, repeat):
+    durations = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        durations.append((time.perf_counter() - t0) * 1000)
+    return durations
+
+
+def report(label, durations):
+    durations = sorted(durations)
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+    print(f"{label:<40} median {statistics.median(durations):8.2f} ms   p95 {p95:8.2f} ms")
+
+
+# Compares the old LIKE '%term%' club search with the FTS5 index from search.py.
+# Both sides only load club ids so the numbers measure the lookup itself, not ORM hydration.
+def bench_search(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app(os.path.join(tmp, "bench.db"))
+        with app.app_context():
+            t0 = time.perf_counter()
+            generate_clubs(args.clubs, args.tags)
+            search.create_search_index()
+            print(f"Generated and indexed {args.clubs} clubs in {time.perf_counter() - t0:.1f}s")
+
+            for term in args.terms:
+                like_count = search.like_search_query(term, ("id",)).count()
+                fts_count = search.search_query(term, ("id",)).count()
+                print(f"\n'{term}': LIKE matches {like_count}, FTS matches {fts_count}")
+                report("  LIKE", timed(lambda: search.like_search_query(term, ("id",)).all(), args.repeat))
+                report("  FTS5", timed(lambda: search.search_query(term, ("id",)).all(), args.repeat))
+                report("  FTS5 top 20", timed(lambda: search.search_query(term, ("id",), limit=20).all(), args.repeat))
+
+
+# The read-modify-write favorite path the API used before favorites.py, kept for comparison.
+def naive_favorite(user_id, club_id, add):
+    user = db.session.get(User, user_id)
+    club = db.session.get(Club, club_id)
+    if add and club not in user.fav_clubs:
+        user.fav_clubs.append(club)
+        club.favorites += 1
+    elif not add and club in user.fav_clubs:
+        user.fav_clubs.remove(club)
+        club.favorites = max(0, club.favorites - 1)
+
+
+# Concurrency stress test for favorite counters. Many threads favorite and unfavorite random clubs
+# for random users at the same time, then every Club.favorites is compared with the number of rows in
+# user_to_favorite_club. Exits with an error if any count drifted.
+def bench_favorites(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app(os.path.join(tmp, "bench.db"))
+        with app.app_context():
+            generate_clubs(args.clubs, 5)
+            db.session.execute(insert(User), [
+                {"id": i, "username": f"user{i}", "email": f"user{i}@upenn.edu", "password_hash": "-",
+                 "first_name": "Test", "last_name": "User", "school": "SEAS", "major": "CIS", "grad_year": 2027}
+                for i in range(1, args.users + 1)
+            ])
+            db.session.commit()
+
+        errors = []
+
+        def worker(seed):
+            rng = random.Random(seed)
+            with app.app_context():
+                for _ in range(args.ops):
+                    user_id, club_id = rng.randint(1, args.users), rng.randint(1, args.clubs)
+                    add = rng.random() < 0.7
+                    for attempt in range(20):
+                        try:
+                            if args.naive:
+                                naive_favorite(user_id, club_id, add)
+                            elif add:
+                                add_favorite(user_id, club_id)
+                            else:
+                                remove_favorite(user_id, club_id)
+                            db.session.commit()
+                            break
+                        except (OperationalError, IntegrityError):
+                            # Locked database, or (naive path only) a duplicate favorite row.
+                            db.session.rollback()
+                            time.sleep(0.001 * 2 ** min(attempt, 6) * rng.random())
+                    else:
+                        errors.append((user_id, club_id))
+
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - t0
+
+        with app.app_context():
+            total_ops = args.threads * args.ops
+            favorites = db.session.execute(select(func.sum(Club.favorites))).scalar()
+            rows = db.session.execute(select(func.count()).select_from(user_to_favorite_club)).scalar()
+            drifted = reconcile_favorites()
+            db.session.rollback()
+        print(f"{total_ops} operations on {args.threads} threads in {elapsed:.2f}s "
+              f"({total_ops / elapsed:.0f} ops/sec), {len(errors)} gave up on a locked database")
+        print(f"Sum of Club.favorites: {favorites}, favorite rows: {rows}, clubs with a wrong count: {drifted}")
+        if drifted:
+            raise SystemExit("Favorite counts drifted")
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# Tag filtering the way SQL would do it without the tag index: one join per tag for match="all",
+# an IN subquery for match="any". Returns club ids in the same order as filter_club_ids.
+def sql_filter_ids(names, match, sort, limit):
+    query = select(Club.id)
+    if match == "all":
+        for name in names:
+            link = clubs_to_tags.alias()
+            tag = Tag.__table__.alias()
+            query = query.join(link, link.c.club_id == Club.id).join(tag, (tag.c.id == link.c.tag_id) & (tag.c.name == name))
+    else:
+        query = query.where(Club.id.in_(
+            select(clubs_to_tags.c.club_id).join(Tag, Tag.id == clubs_to_tags.c.tag_id).where(Tag.name.in_(names))
+        ))
+    query = query.order_by(Club.favorites.desc(), Club.id) if sort == "favorites" else query.order_by(Club.id)
+    return db.session.execute(query.limit(limit) if limit else query).scalars().all()
+
+
+# Writes clubs the way the club endpoints do, including renames together with tag changes, and exits
+# with an error if tag_stats or the tag index no longer match clubs_to_tags.
+def check_club_writes():
+    club = db.session.get(Club, 1)
+    update_club(club, {"name": "Renamed Club 1", "tags": ["tag-2", "retagged"]}, resolve_tags(["tag-2", "retagged"]))
+    commit_club_writes([club], renamed=[club])
+    write_club_batch([
+        {"code": "club-2", "name": "Renamed Club 2", "tags": ["retagged"]},
+        {"code": "new-club", "name": "New Club", "description": "New", "tags": ["retagged", "tag-1"]},
+    ], upsert=True)
+
+    for name, stored, actual in check_tag_stats():
+        raise SystemExit(f"tag_stats is wrong after club writes: {name} stored {stored}, actual {actual}")
+    for names in (["retagged"], ["tag-1"], ["tag-2"]):
+        if filter_club_ids(names)[0] != sql_filter_ids(names, "all", "id", None):
+            raise SystemExit(f"Tag index and SQL disagree for {names} after club writes")
+    print("Tag counts and tag index are consistent after club writes")
+
+
+# Compares tag filtering with the in-memory bitsets of tag_index.py against SQL joins over clubs_to_tags.
+# Checks the tag counts and the index after a few club writes first (see check_club_writes).
+def bench_tag_filter(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app(os.path.join(tmp, "bench.db"))
+        with app.app_context():
+            t0 = time.perf_counter()
+            generate_clubs(args.clubs, args.tags)
+            db.session.execute(update(Club).values(favorites=func.abs(func.random()) % 1000))
+            db.session.commit()
+            create_versions()
+            print(f"Generated {args.clubs} clubs with {args.tags} tags in {time.perf_counter() - t0:.1f}s")
+            t0 = time.perf_counter()
+            tag_index.rebuild()
+            print(f"Built the tag index in {(time.perf_counter() - t0) * 1000:.0f} ms")
+            search.create_search_index()
+            rebuild_tag_stats()
+            db.session.commit()
+            check_club_writes()
+
+            cases = [
+                (["tag-1"], "all", "id", None),
+                (["tag-1", "tag-2"], "all", "id", None),
+                (["tag-1", "tag-2", "tag-3"], "any", "id", None),
+                (["tag-1", "tag-2", "tag-3"], "any", "favorites", 20),
+                ([f"tag-{i}" for i in range(1, 101)], "any", "favorites", 20),
+            ]
+            for names, match, sort, limit in cases:
+                ids, _ = filter_club_ids(names, match, sort, limit)
+                if ids != sql_filter_ids(names, match, sort, limit):
+                    raise SystemExit(f"Tag index and SQL disagree for {names} {match} {sort}")
+                label = f"{len(names)} tags, match={match}, sort={sort}" + (f", limit={limit}" if limit else "")
+                print(f"\n{label}: {len(ids)} clubs")
+                report("  SQL joins", timed(lambda: sql_filter_ids(names, match, sort, limit), args.repeat))
+                report("  tag index", timed(lambda: filter_club_ids(names, match, sort, limit), args.repeat))
+
+
+# Mixed read/write load against each SQLite engine profile in db.py. Writer threads post comments and
+# toggle favorites, retried with retry_on_busy like the API's write endpoints, while reader threads list
+# a club's comments and a page of clubs. Reports throughput, read latency and how often writers hit a
+# locked database.
+def bench_concurrency(args):
+    for profile in args.profiles:
+        with tempfile.TemporaryDirectory() as tmp:
+            app = bench_app(os.path.join(tmp, "bench.db"), profile)
+            with app.app_context():
+                generate_clubs(args.clubs, 20)
+                db.session.execute(insert(User), [
+                    {"id": i, "username": f"user{i}", "email": f"user{i}@upenn.edu", "password_hash": "-",
+                     "first_name": "Test", "last_name": "User", "school": "SEAS", "major": "CIS", "grad_year": 2027}
+                    for i in range(1, args.users + 1)
+                ])
+                db.session.commit()
+
+            busy_stats.update(retries=0, failures=0)
+            stop = threading.Event()
+            writes = []
+            reads = []
+
+            @retry_on_busy
+            def write(rng):
+                user_id, club_id = rng.randint(1, args.users), rng.randint(1, args.clubs)
+                db.session.add(Comment(text=" ".join(rng.choices(WORDS, k=12)), user_id=user_id, club_id=club_id))
+                if rng.random() < 0.5:
+                    add_favorite(user_id, club_id)
+                else:
+                    remove_favorite(user_id, club_id)
+                db.session.commit()
+
+            def writer(seed):
+                rng = random.Random(seed)
+                with app.app_context():
+                    while not stop.is_set():
+                        try:
+                            write(rng)
+                            writes.append(1)
+                        except OperationalError:
+                            pass
+
+            def reader(seed):
+                rng = random.Random(seed)
+                with app.app_context():
+                    while not stop.is_set():
+                        club = db.session.get(Club, rng.randint(1, args.clubs))
+                        t0 = time.perf_counter()
+                        club_comments(club, None, 50, None)
+                        clubs_query().limit(20).all()
+                        reads.append((time.perf_counter() - t0) * 1000)
+                        db.session.rollback()
+
+            threads = [threading.Thread(target=writer, args=(seed,)) for seed in range(args.writers)]
+            threads += [threading.Thread(target=reader, args=(seed,)) for seed in range(args.readers)]
+            for thread in threads:
+                thread.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+            print(f"\n{profile} profile: {len(writes) / args.seconds:.0f} writes/sec, "
+                  f"{len(reads) / args.seconds:.0f} reads/sec, {busy_stats['retries']} retries on a locked "
+                  f"database, {busy_stats['failures']} writes failed")
+            report("  read", reads)
+
+
+# Sends one request to the local server and returns (status, milliseconds).
+def http_request(port, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    t0 = time.perf_counter()
+    conn.request(method, path, body=json.dumps(body) if body else None,
+                 headers={"Content-Type": "application/json", **(headers or {})})
+    response = conn.getresponse()
+    response.read()
+    conn.close()
+    return response.status, (time.perf_counter() - t0) * 1000
+
+
+# Measures GET /api/clubs latency before and during a login storm. The real login and club list views
+# from app.py are served by a threaded HTTP server on a temporary database; storm threads log in as fast
+# as they can while a reader times the club list. With --inline every login hashes on its request
+# thread, as before passwords.py, which shows how much the storm slows down the other endpoints.
+def bench_login_storm(args):
+    from app import get_all_clubs, login
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app(os.path.join(tmp, "bench.db"))
+        app.config["SECRET_KEY"] = "benchmark"
+        app.config["PASSWORD_WORKERS"] = 0 if args.inline else args.workers
+        app.config["PASSWORD_MAX_PENDING"] = args.max_pending
+        hasher.init_app(app)
+        app.add_url_rule("/api/login", view_func=login, methods=["POST"])
+        app.add_url_rule("/api/clubs", view_func=get_all_clubs)
+        with app.app_context():
+            generate_clubs(args.clubs, 20)
+            create_versions()
+            db.session.add(User(username="storm", email="storm@upenn.edu", first_name="Test", last_name="User",
+                                school="SEAS", major="CIS", grad_year=2027,
+                                password_hash=generate_password_hash("password", hasher.method)))
+            db.session.commit()
+
+        server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+
+        def read_latencies():
+            return [http_request(port, "GET", "/api/clubs?limit=20")[1] for _ in range(args.reads)]
+
+        report("/api/clubs, idle", read_latencies())
+
+        stop = threading.Event()
+        statuses = []
+
+        def storm():
+            while not stop.is_set():
+                statuses.append(http_request(port, "POST", "/api/login", {"username": "storm", "password": "password"}))
+
+        threads = [threading.Thread(target=storm) for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.5)
+        report(f"/api/clubs, {args.threads} threads logging in", read_latencies())
+        stop.set()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+
+        for status in sorted({status for status, _ in statuses}):
+            durations = [ms for code, ms in statuses if code == status]
+            report(f"/api/login {status} x{len(durations)}", durations)
+
+
+# Sends a GET request and reads the body in chunks. Returns (milliseconds to the first byte of the
+# body, milliseconds to the end of it, body size in bytes).
+def http_get_timed(port, path, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=600)
+    t0 = time.perf_counter()
+    conn.request("GET", path, headers=headers or {})
+    response = conn.getresponse()
+    size = len(response.read(1))
+    ttfb = (time.perf_counter() - t0) * 1000
+    while chunk := response.read(65536):
+        size += len(chunk)
+    conn.close()
+    return ttfb, (time.perf_counter() - t0) * 1000, size
+
+
+# Compares the streamed club and comment lists with the old path, which built the whole list of dicts
+# and the whole JSON string before sending anything. The real views from app.py and the old ones are
+# served by an HTTP server on a temporary database. Reports time to first byte and total time over
+# HTTP, and the peak Python memory allocated while serving one request, measured with tracemalloc.
+def bench_streaming(args):
+    from app import get_all_clubs, get_club_comments
+
+    def buffered_clubs():
+        return jsonify([club.to_dict() for club in clubs_query().all()])
+
+    def buffered_comments(code):
+        club = db.session.query(Club).filter_by(code=code).first()
+        return jsonify([comment.to_dict() for comment in comments_query().filter(Comment.club_id == club.id).all()])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app(os.path.join(tmp, "bench.db"), "tuned")
+        app.config["CACHE_ENABLED"] = False
+        app.add_url_rule("/api/clubs", view_func=get_all_clubs)
+        app.add_url_rule("/api/clubs/<string:code>/comments", view_func=get_club_comments)
+        app.add_url_rule("/buffered/clubs", view_func=buffered_clubs)
+        app.add_url_rule("/buffered/clubs/<string:code>/comments", view_func=buffered_comments)
+        with app.app_context():
+            generate_clubs(args.clubs, 50)
+            db.session.add(User(id=1, username="bench", email="bench@upenn.edu", password_hash="-", first_name="Test",
+                                last_name="User", school="SEAS", major="CIS", grad_year=2027))
+            rng = random.Random(0)
+            vocab = vocabulary(rng)
+            for start in range(1, args.comments + 1, 10000):
+                db.session.execute(insert(Comment), [
+                    {"id": i, "user_id": 1, "club_id": 1, "text": random_text(rng, vocab, 30)}
+                    for i in range(start, min(start + 10000, args.comments + 1))
+                ])
+            db.session.commit()
+            create_versions()
+        print(f"Generated {args.clubs} clubs and {args.comments} comments on one club")
+
+        server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        client = app.test_client()
+        cases = [
+            ("clubs, buffered", "/buffered/clubs", None),
+            ("clubs, streamed", "/api/clubs", None),
+            ("clubs, NDJSON", "/api/clubs", {"Accept": "application/x-ndjson"}),
+            ("comments, buffered", "/buffered/clubs/club-1/comments", None),
+            ("comments, streamed", "/api/clubs/club-1/comments", None),
+            ("comments, NDJSON", "/api/clubs/club-1/comments", {"Accept": "application/x-ndjson"}),
+        ]
+        for label, path, headers in cases:
+            timings = [http_get_timed(server.server_port, path, headers) for _ in range(args.repeat)]
+            tracemalloc.start()
+            for _ in client.get(path, headers=headers).response:
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"\n{label}: {timings[0][2] / 2 ** 20:.1f} MB, peak Python memory {peak / 2 ** 20:.1f} MB")
+            report("  first byte", [ttfb for ttfb, _, _ in timings])
+            report("  whole body", [total for _, total, _ in timings])
+        server.shutdown()
+
+
+# Compares GET /api/clubs assembled from the pre-encoded fragments of club_fragments.py with loading
+# and encoding the clubs on every request (CLUB_FRAGMENTS off), for pages, tag filters, the favorites
+# order and the full list. Also reports how long building every fragment takes and how much memory
+# they use, and the cost of bringing them up to date after a favorite.
+def bench_club_list(args):
+    from app import get_all_clubs
+    from club_fragments import club_fragments
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app(os.path.join(tmp, "bench.db"), "tuned")
+        app.add_url_rule("/api/clubs", view_func=get_all_clubs)
+        with app.app_context():
+            generate_clubs(args.clubs, args.tags)
+            db.session.execute(update(Club).values(favorites=func.abs(func.random()) % 1000))
+            db.session.commit()
+            create_versions()
+            tag_index.rebuild()
+            print(f"Generated {args.clubs} clubs")
+
+            t0 = time.perf_counter()
+            club_fragments.refresh()
+            elapsed = time.perf_counter() - t0
+            # Built again under tracemalloc, which would slow down the timed build.
+            tracemalloc.start()
+            club_fragments.rebuild(club_fragments.version)
+            retained = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            stats = club_fragments.stats()
+            print(f"Built {stats['clubs']} fragments in {elapsed * 1000:.0f} ms: {stats['bytes'] / 2 ** 20:.1f} MB "
+                  f"of JSON, {retained / 2 ** 20:.1f} MB retained ({retained / stats['clubs']:.0f} bytes per club)")
+
+            add_favorite(1, args.clubs // 2)
+            bump("favorites")
+            db.session.commit()
+            report("  refresh after one favorite", timed(club_fragments.refresh, 1))
+
+        client = app.test_client()
+        paths = ["/api/clubs?limit=20", f"/api/clubs?limit=20&after={args.clubs // 2}",
+                 "/api/clubs?tags=tag-1&limit=20", "/api/clubs?sort=favorites&limit=20", "/api/clubs"]
+        for path in paths:
+            print(f"\n{path}")
+            for label, enabled in (("load and encode", False), ("fragments", True)):
+                club_fragments.enabled = enabled
+                repeat = args.repeat if "limit" in path else max(1, args.repeat // 10)
+                report(f"  {label}", timed(lambda: client.get(path).get_data(), repeat))
+
+
+# Compares the top clubs of a trending window read from the rollups in trending.py with the same
+# ranking aggregated live from comment timestamps and favorite times. Both sides only load club ids.
+def bench_trending(args):
+    import trending
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app = bench_app(os.path.join(tmp, "bench.db"), "tuned")
+        with app.app_context():
+            create_versions()
+            counts = generate(args.clubs, args.tags, args.users, args.favorites, args.comments, days=args.days)
+            print(f"Generated {', '.join(f'{count} {table}' for table, count in counts.items())} over {args.days} days")
+
+            bucket = trending.current_bucket()
+            for window, start in trending.window_starts(bucket).items():
+                since = datetime.datetime.fromtimestamp(start * trending.BUCKET_SECONDS, datetime.timezone.utc)
+                since = since.replace(tzinfo=None)
+                activity = union_all(
+                    select(Comment.club_id.label("club_id"), literal(1).label("points"))
+                    .where(Comment.timestamp >= since),
+                    select(user_to_favorite_club.c.club_id, literal(trending.FAVORITE_WEIGHT))
+                    .where(user_to_favorite_club.c.created_at >= since),
+                ).subquery()
+                score = func.sum(activity.c.points)
+                live = (
+                    select(activity.c.club_id).group_by(activity.c.club_id)
+                    .order_by(score.desc(), activity.c.club_id).limit(args.limit)
+                )
+                rollup = (
+                    select(trending_score.c.club_id)
+                    .where(trending_score.c.window_name == window, trending_score.c.score > 0)
+                    .order_by(trending_score.c.score.desc(), trending_score.c.club_id).limit(args.limit)
+                )
+                same = db.session.execute(live).scalars().all() == db.session.execute(rollup).scalars().all()
+                print(f"\nTop {args.limit} over {window} (same ranking: {same})")
+                report("  live aggregate", timed(lambda: db.session.execute(live).all(), args.repeat))
+                report("  rollups", timed(lambda: db.session.execute(rollup).all(), args.repeat))
+
+            print()
+            report("favorite with rollup updates", timed(lambda: (add_favorite(1, args.clubs), db.session.rollback()),
+                                                          args.repeat))
+            t0 = time.perf_counter()
+            trending.compact_trending(bucket + 1)
+            db.session.commit()
+            print(f"Compacting one hour took {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+
+# Reads a request mix: one JSON request template per line with a name, method, path, weight and
+# optionally a JSON body and "auth": true for endpoints that need a logged in user. Paths and body
+# strings may use the placeholders filled in by fill_template().
+def load_request_mix(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# Fills the {placeholders} of a path or JSON body with values picked by the client.
+def fill_template(template, values):
+    if isinstance(template, str):
+        return template.format_map(values)
+    if isinstance(template, dict):
+        return {key: fill_template(value, values) for key, value in template.items()}
+    if isinstance(template, list):
+        return [fill_template(value, values) for value in template]
+    return template
+
+
+# Nearest-rank percentile of a sorted list.
+def percentile(durations, q):
+    return durations[min(len(durations) - 1, int(len(durations) * q))]
+
+
+# Summarizes (name, status, milliseconds) results per request name: count, requests per second,
+# server errors (5xx or no response), other non-2xx responses and p50/p95/p99 latency.
+def summarize(results, seconds):
+    endpoints = {}
+    for name in sorted({name for name, _, _ in results}):
+        statuses = [status for result_name, status, _ in results if result_name == name]
+        durations = sorted(ms for result_name, _, ms in results if result_name == name)
+        endpoints[name] = {
+            "count": len(durations),
+            "rps": len(durations) / seconds,
+            "errors": sum(1 for status in statuses if status is None or status >= 500),
+            "non_2xx": sum(1 for status in statuses if status is not None and not 200 <= status < 300),
+            "p50": percentile(durations, 0.5),
+            "p95": percentile(durations, 0.95),
+            "p99": percentile(durations, 0.99),
+        }
+    return endpoints
+
+
+def print_summary(endpoints):
+    print(f"{'endpoint':<24}{'count':>8}{'req/s':>9}{'errors':>8}{'non-2xx':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for name, stats in endpoints.items():
+        print(f"{name:<24}{stats['count']:>8}{stats['rps']:>9.1f}{stats['errors']:>8}{stats['non_2xx']:>9}"
+              f"{stats['p50']:>9.1f}{stats['p95']:>9.1f}{stats['p99']:>9.1f}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# Load test of the whole API. Fills a temporary SQLite database with datagen.py, serves the real app
+# from app.py with a threaded HTTP server and has --clients concurrent clients, each logged in as its
+# own user, replay the weighted request mix (request_mix.jsonl) for --seconds. Reports throughput and
+# p50/p95/p99 latency per request name, and saves them with the commit they ran on to --save-dir so
+# runs can be compared with `python benchmark.py compare`.
+def bench_replay(args):
+    mix = load_request_mix(args.mix)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'replay.db')}"
+        os.environ["DB_PROFILE"] = args.profile
+        from app import app, init_db
+        from migrations import migrate
+
+        with app.app_context():
+            t0 = time.perf_counter()
+            migrate()
+            counts = generate(args.clubs, args.tags, args.users, args.favorites, args.comments, seed=args.seed)
+            init_db()
+            club_codes = db.session.execute(select(Club.code).limit(10000)).scalars().all()
+            tags = db.session.execute(select(Tag.name)).scalars().all()
+            print(f"Generated {', '.join(f'{count} {table}' for table, count in counts.items())} "
+                  f"in {time.perf_counter() - t0:.1f}s")
+
+        server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_port
+        words = WORDS + ["penn rob", "chess club"]
+
+        results = []
+        deadline = None
+
+        def client(client_id):
+            rng = random.Random(args.seed * 1000 + client_id)
+            me = client_id % args.users + 1
+            # Logins past the password pool's limit get 503 and are retried.
+            token = None
+            while token is None:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+                conn.request("POST", "/api/login", body=json.dumps({"username": f"user{me}", "password": PASSWORD}),
+                             headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                body = response.read()
+                conn.close()
+                if response.status == 200:
+                    token = json.loads(body)["token"]
+                else:
+                    time.sleep(0.1)
+            ready.wait()
+            weights = [entry["weight"] for entry in mix]
+            while time.perf_counter() < deadline:
+                entry = rng.choices(mix, weights=weights)[0]
+                values = {
+                    "me": me, "user_id": rng.randint(1, args.users), "club_id": rng.randint(0, args.clubs),
+                    "club_code": rng.choice(club_codes), "comment_id": rng.randint(1, max(args.comments, 1)),
+                    "tag": rng.choice(tags), "word": rng.choice(words).replace(" ", "%20"),
+                    "text": " ".join(rng.choices(WORDS, k=12)),
+                }
+                headers = {"Authorization": f"Bearer {token}"} if entry.get("auth") else None
+                try:
+                    status, ms = http_request(port, entry["method"], fill_template(entry["path"], values),
+                                              fill_template(entry.get("body"), values), headers)
+                except OSError:
+                    status, ms = None, 0
+                results.append((entry["name"], status, ms))
+
+        ready = threading.Event()
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+        for thread in threads:
+            thread.start()
+        deadline = time.perf_counter() + args.seconds
+        ready.set()
+        for thread in threads:
+            thread.join()
+        server.shutdown()
+
+    endpoints = summarize(results, args.seconds)
+    print(f"\n{len(results)} requests from {args.clients} clients in {args.seconds:.0f}s "
+          f"({len(results) / args.seconds:.0f} req/s)\n")
+    print_summary(endpoints)
+
+    run = {
+        "commit": git_commit(),
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "args": {key: value for key, value in vars(args).items() if key != "func"},
+        "rps": len(results) / args.seconds,
+        "endpoints": endpoints,
+    }
+    os.makedirs(args.save_dir, exist_ok=True)
+    path = os.path.join(args.save_dir, f"{run['time'].replace(':', '')}-{run['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+    print(f"\nSaved results to {path}")
+
+
+# Compares two saved replay runs, printing the change in throughput and latency per request name.
+def bench_compare(args):
+    runs = []
+    for path in (args.before, args.after):
+        with open(path) as f:
+            runs.append(json.load(f))
+    before, after = runs
+    print(f"{before['commit']} ({before['time']}) -> {after['commit']} ({after['time']})")
+    print(f"total: {before['rps']:.1f} -> {after['rps']:.1f} req/s ({change(before['rps'], after['rps'])})\n")
+    print(f"{'endpoint':<24}{'req/s':>22}{'p50 ms':>22}{'p95 ms':>22}{'p99 ms':>22}")
+    for name in sorted(set(before["endpoints"]) | set(after["endpoints"])):
+        old, new = before["endpoints"].get(name), after["endpoints"].get(name)
+        if old is None or new is None:
+            print(f"{name:<24} only in {'after' if old is None else 'before'}")
+            continue
+        columns = [f"{old[key]:.1f} -> {new[key]:.1f} {change(old[key], new[key]):>6}"
+                   for key in ("rps", "p50", "p95", "p99")]
+        print(f"{name:<24}" + "".join(f"{column:>22}" for column in columns))
+
+
+def change(old, new):
+    return f"{(new - old) / old * 100:+.0f}%" if old else "n/a"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Penn Club Review benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    search_parser = subparsers.add_parser("search", help="LIKE scan vs FTS5 club search")
+    search_parser.add_argument("--clubs", type=int, default=100000)
+    search_parser.add_argument("--tags", type=int, default=50)
+    search_parser.add_argument("--repeat", type=int, default=20)
+    search_parser.add_argument("--terms", nargs="+", default=["juggling", "penn rob", "chess club", "xyzzy", "ba", "kelo"])
+    search_parser.set_defaults(func=bench_search)
+
+    favorites_parser = subparsers.add_parser("favorites", help="concurrent favorite/unfavorite stress test")
+    favorites_parser.add_argument("--clubs", type=int, default=20)
+    favorites_parser.add_argument("--users", type=int, default=200)
+    favorites_parser.add_argument("--threads", type=int, default=16)
+    favorites_parser.add_argument("--ops", type=int, default=300, help="operations per thread")
+    favorites_parser.add_argument("--naive", action="store_true", help="use the old read-modify-write path")
+    favorites_parser.set_defaults(func=bench_favorites)
+
+    tag_filter_parser = subparsers.add_parser("tag-filter", help="tag index bitsets vs SQL joins")
+    tag_filter_parser.add_argument("--clubs", type=int, default=100000)
+    tag_filter_parser.add_argument("--tags", type=int, default=1000)
+    tag_filter_parser.add_argument("--repeat", type=int, default=20)
+    tag_filter_parser.set_defaults(func=bench_tag_filter)
+
+    concurrency_parser = subparsers.add_parser("concurrency", help="mixed read/write load per SQLite profile")
+    concurrency_parser.add_argument("--profiles", nargs="+", choices=sorted(SQLITE_PROFILES),
+                                    default=["default", "tuned"])
+    concurrency_parser.add_argument("--clubs", type=int, default=1000)
+    concurrency_parser.add_argument("--users", type=int, default=200)
+    concurrency_parser.add_argument("--writers", type=int, default=8)
+    concurrency_parser.add_argument("--readers", type=int, default=8)
+    concurrency_parser.add_argument("--seconds", type=float, default=10)
+    concurrency_parser.set_defaults(func=bench_concurrency)
+
+    storm_parser = subparsers.add_parser("login-storm", help="read latency while many clients log in")
+    storm_parser.add_argument("--clubs", type=int, default=1000)
+    storm_parser.add_argument("--threads", type=int, default=16, help="clients logging in concurrently")
+    storm_parser.add_argument("--reads", type=int, default=100, help="club list requests timed per phase")
+    storm_parser.add_argument("--workers", type=int, default=2, help="password hashing processes")
+    storm_parser.add_argument("--max-pending", type=int, default=8, help="hashes queued before logins get 503")
+    storm_parser.add_argument("--inline", action="store_true", help="hash on the request thread instead")
+    storm_parser.set_defaults(func=bench_login_storm)
+
+    streaming_parser = subparsers.add_parser("streaming", help="streamed vs buffered list responses")
+    streaming_parser.add_argument("--clubs", type=int, default=100000)
+    streaming_parser.add_argument("--comments", type=int, default=100000)
+    streaming_parser.add_argument("--repeat", type=int, default=5)
+    streaming_parser.set_defaults(func=bench_streaming)
+
+    club_list_parser = subparsers.add_parser("club-list", help="club list from pre-encoded fragments vs the ORM")
+    club_list_parser.add_argument("--clubs", type=int, default=100000)
+    club_list_parser.add_argument("--tags", type=int, default=1000)
+    club_list_parser.add_argument("--repeat", type=int, default=50)
+    club_list_parser.set_defaults(func=bench_club_list)
+
+    trending_parser = subparsers.add_parser("trending", help="trending clubs from rollups vs a live aggregate")
+    trending_parser.add_argument("--clubs", type=int, default=10000)
+    trending_parser.add_argument("--tags", type=int, default=200)
+    trending_parser.add_argument("--users", type=int, default=20000)
+    trending_parser.add_argument("--favorites", type=int, default=10, help="average favorite clubs per user")
+    trending_parser.add_argument("--comments", type=int, default=500000)
+    trending_parser.add_argument("--days", type=int, default=7, help="days the activity is spread over")
+    trending_parser.add_argument("--limit", type=int, default=20)
+    trending_parser.add_argument("--repeat", type=int, default=20)
+    trending_parser.set_defaults(func=bench_trending)
+
+    replay_parser = subparsers.add_parser("replay", help="load test the API with a recorded request mix")
+    replay_parser.add_argument("--mix", default="request_mix.jsonl", help="request mix file")
+    replay_parser.add_argument("--clubs", type=int, default=10000)
+    replay_parser.add_argument("--tags", type=int, default=200)
+    replay_parser.add_argument("--users", type=int, default=5000)
+    replay_parser.add_argument("--favorites", type=int, default=5, help="average favorite clubs per user")
+    replay_parser.add_argument("--comments", type=int, default=100000)
+    replay_parser.add_argument("--clients", type=int, default=8, help="concurrent clients")
+    replay_parser.add_argument("--seconds", type=float, default=30)
+    replay_parser.add_argument("--profile", choices=sorted(SQLITE_PROFILES), default="tuned")
+    replay_parser.add_argument("--seed", type=int, default=0)
+    replay_parser.add_argument("--save-dir", default="bench_results", help="directory for the results file")
+    replay_parser.set_defaults(func=bench_replay)
+
+    compare_parser = subparsers.add_parser("compare", help="compare two saved replay runs")
+    compare_parser.add_argument("before", help="results file of the baseline run")
+    compare_parser.add_argument("after", help="results file of the new run")
+    compare_parser.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,8 @@
 import os
-import json
-import time
 
-from app import app, DB_FILE
+from app import app, DB_FILE, init_db
 from db import db
+from loader import format_stats, iter_clubs, load_clubs
 from models import *
 
 # This file is used to bootstrap the database with initial data.
@@ -21,35 +20,24 @@ def create_user():
     user_minghan.set_password("password")
     db.session.add(user_minghan)
 
-# Iterates through the clubs.json file and adds each club to the database as an object.
-# Tags are added seperately by adding them to the club's tags list after the club is created.
+# Streams the clubs.json file into the database with the bulk loader in loader.py.
+# Larger dumps can be loaded the same way with `python manage.py load <file>`.
 def load_data():
-    t0 = time.time()
-    with open("clubs.json", 'r') as file:
-        clubs_data = json.load(file)
-    for club_data in clubs_data:
-        club = Club(code=club_data['code'], name=club_data['name'], description=club_data['description'])
-        db.session.add(club)
-        for tag_data in club_data['tags']:
-            tag = Tag.query.filter_by(name=tag_data).first()
-            if not tag:
-                tag = Tag(name=tag_data)
-                db.session.add(tag)
-            club.tags.append(tag)
-    db.session.commit()
-    t1 = time.time()
-    print(t1-t0)
+    stats = load_clubs(iter_clubs("clubs.json"))
+    print(format_stats(stats))
 
 
 
 # No need to modify the below code.
 if __name__ == "__main__":
     # Delete any existing database before bootstrapping a new one.
+    # The -wal and -shm files are left next to it by WAL mode and must go too.
     LOCAL_DB_FILE = "instance/" + DB_FILE
-    if os.path.exists(LOCAL_DB_FILE):
-        os.remove(LOCAL_DB_FILE)
+    for path in (LOCAL_DB_FILE, LOCAL_DB_FILE + "-wal", LOCAL_DB_FILE + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
     with app.app_context():
-        db.create_all()
+        init_db()
         create_user()
-        load_data()
\ No newline at end of file
+        load_data()
@@ -0,0 +1,260 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, make_response, request
+
+from queries import wants_ndjson
+
+# Response cache for read endpoints that are read far more often than they are written.
+# Cached views are grouped by what they depend on, e.g. "club_comments:{code}". A cache entry's key is
+# the group, the group's generation number and the request path with its query string, so every
+# variant of a route (pagination, fields, ...) is cached separately. Write handlers call invalidate()
+# with the groups they affected, which bumps those generations so all of their entries become
+# unreachable at once and age out of the LRU. Other groups are left untouched.
+# Writers outside the web process (manage.py commands) invalidate the groups they affect the same way,
+# which reaches every worker when the cache is shared through the sqlite backend.
+# Streamed responses are cached as their body goes out, unless it grows past CACHE_MAX_BODY bytes.
+#
+# Storage is pluggable through CacheBackend. MemoryBackend is a per-process LRU+TTL dict;
+# SQLiteBackend stores entries in a local SQLite file so several worker processes share one cache.
+
+
+# Interface for cache storage. Entries are evictable and expire after their ttl;
+# counters hold group generations and are never evicted, so a stale generation can't come back.
+class CacheBackend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def get_counter(self, name):
+        raise NotImplementedError
+
+    def incr_counter(self, name):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    # Number of entries dropped to make room for new ones.
+    evictions = 0
+
+
+# In-process LRU cache with a per-entry TTL and a bound on the number of entries.
+class MemoryBackend(CacheBackend):
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.counters = {}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def get_counter(self, name):
+        return self.counters.get(name, 0)
+
+    def incr_counter(self, name):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+            return self.counters[name]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.counters.clear()
+
+
+# Cache stored in a local SQLite file, shared by every worker process on the machine.
+# Entries are evicted least recently used first once there are more than max_entries.
+class SQLiteBackend(CacheBackend):
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.evictions = 0
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_entry "
+                         "(key TEXT PRIMARY KEY, value BLOB, expires_at REAL, used_at REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS index_cache_entry_used_at ON cache_entry (used_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache_counter (name TEXT PRIMARY KEY, value INTEGER)")
+
+    def connection(self):
+        if getattr(self.local, "conn", None) is None:
+            self.local.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self.local.conn.execute("PRAGMA journal_mode=WAL")
+        return self.local.conn
+
+    def get(self, key):
+        conn = self.connection()
+        now = time.time()
+        row = conn.execute("SELECT value FROM cache_entry WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE cache_entry SET used_at = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl):
+        conn = self.connection()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO cache_entry (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                     (key, pickle.dumps(value), now + ttl, now))
+        overflow = conn.execute("SELECT count(*) FROM cache_entry").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            conn.execute("DELETE FROM cache_entry WHERE key IN "
+                         "(SELECT key FROM cache_entry ORDER BY used_at LIMIT ?)", (overflow,))
+            self.evictions += overflow
+
+    def delete(self, key):
+        self.connection().execute("DELETE FROM cache_entry WHERE key = ?", (key,))
+
+    def get_counter(self, name):
+        row = self.connection().execute("SELECT value FROM cache_counter WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def incr_counter(self, name):
+        conn = self.connection()
+        conn.execute("INSERT INTO cache_counter (name, value) VALUES (?, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,))
+        return self.get_counter(name)
+
+    def clear(self):
+        conn = self.connection()
+        conn.execute("DELETE FROM cache_entry")
+        conn.execute("DELETE FROM cache_counter")
+
+
+class ResponseCache:
+    def __init__(self):
+        self.backend = None
+        self.ttl = 60
+        self.max_body = 1 << 20
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # Reads the cache settings from the app config:
+    # CACHE_BACKEND is "memory" (default), "sqlite" or a CacheBackend instance,
+    # CACHE_TTL is the lifetime of an entry in seconds, CACHE_MAX_ENTRIES bounds the number of entries
+    # CACHE_SQLITE_PATH is the file used by the sqlite backend (instance/cache.db by default)
+    # and CACHE_MAX_BODY is the largest streamed body in bytes that is kept.
+    def init_app(self, app):
+        self.ttl = app.config.get("CACHE_TTL", 60)
+        self.max_body = app.config.get("CACHE_MAX_BODY", 1 << 20)
+        max_entries = app.config.get("CACHE_MAX_ENTRIES", 1024)
+        backend = app.config.get("CACHE_BACKEND", "memory")
+        if backend == "memory":
+            backend = MemoryBackend(max_entries)
+        elif backend == "sqlite":
+            os.makedirs(app.instance_path, exist_ok=True)
+            path = app.config.get("CACHE_SQLITE_PATH", os.path.join(app.instance_path, "cache.db"))
+            backend = SQLiteBackend(path, max_entries)
+        self.backend = backend
+
+    # NDJSON and JSON list responses to the same path are cached separately.
+    def key(self, group):
+        generation = self.backend.get_counter(group)
+        variant = ":ndjson" if wants_ndjson() else ""
+        return f"{group}:{generation}:{request.full_path}{variant}"
+
+    # Caches successful responses of the decorated view. group is formatted with the view's
+    # URL parameters, e.g. @cache.cached("user:{user_id}").
+    def cached(self, group):
+        def decorator(f):
+            @wraps(f)
+            def decorated(*args, **kwargs):
+                if self.backend is None or not current_app.config.get("CACHE_ENABLED", True):
+                    return f(*args, **kwargs)
+
+                key = self.key(group.format(**kwargs))
+                entry = self.backend.get(key)
+                if entry is not None:
+                    self.hits += 1
+                    body, headers = entry
+                    return current_app.response_class(body, status=200, headers=headers)
+
+                self.misses += 1
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200:
+                    headers = [(name, value) for name, value in response.headers if name != "Content-Length"]
+                    if response.is_streamed:
+                        response.response = self.store_streamed(key, response.response, headers)
+                    else:
+                        self.backend.set(key, (response.get_data(), headers), self.ttl)
+                return response
+
+            return decorated
+
+        return decorator
+
+    # Passes the chunks of a streamed body through and stores the whole body once it has been sent.
+    # Bodies over max_body, or that aren't sent to the end, aren't stored.
+    def store_streamed(self, key, chunks, headers):
+        body = []
+        size = 0
+        try:
+            for chunk in chunks:
+                if body is not None:
+                    data = chunk.encode() if isinstance(chunk, str) else chunk
+                    size += len(data)
+                    if size <= self.max_body:
+                        body.append(data)
+                    else:
+                        body = None
+                yield chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        if body is not None:
+            self.backend.set(key, (b"".join(body), headers), self.ttl)
+
+    # Drops every cached response in the given groups. Call after the write has been committed.
+    def invalidate(self, *groups):
+        if self.backend is None:
+            return
+        for group in groups:
+            self.backend.incr_counter(group)
+            self.invalidations += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions if self.backend else 0,
+            "invalidations": self.invalidations,
+        }
+
+
+cache = ResponseCache()
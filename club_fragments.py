@@ -0,0 +1,84 @@
+import bisect
+import threading
+
+from flask import current_app
+
+from models import *
+from queries import STREAM_BATCH_SIZE, clubs_query, stream_encoded
+from versions import current_versions
+
+# Pre-encoded JSON for every club, so GET /api/clubs can answer by joining bytes instead of loading
+# clubs through the ORM and encoding each one on every request.
+# Each club's fragment is the compact JSON of Club.to_dict(), exactly what the list endpoint would have
+# encoded for it. The fragments are stamped with the club version (the sum of the "club" and "favorites"
+# counters, see models.CLUB_VERSIONS); when it has moved, only the clubs whose revision is above the
+# stamp (see models.next_club_revision) are loaded and re-encoded, which covers club edits, tag changes
+# and favorites alike, from this process or any other. The first lookup builds every fragment.
+
+class ClubFragments:
+    def __init__(self):
+        self.enabled = True
+        self.fragments = {}
+        self.ids = []
+        self.version = None
+        self.lock = threading.Lock()
+        self.rebuilds = 0
+        self.updates = 0
+
+    # CLUB_FRAGMENTS turns the fragments on (the default) or off.
+    def init_app(self, app):
+        self.enabled = app.config.get("CLUB_FRAGMENTS", True)
+
+    def encode(self, club):
+        return current_app.json.dumps(club.to_dict(), separators=(",", ":")).encode()
+
+    # Brings the fragments up to date with the database.
+    def refresh(self):
+        version = sum(current_versions(CLUB_VERSIONS))
+        if version == self.version:
+            return
+        with self.lock:
+            if self.version is None or version < self.version:
+                self.rebuild(version)
+                return
+            if version == self.version:
+                return
+            # Read after the version, so anything committed in between is only loaded again next time.
+            changed = clubs_query().filter(Club.revision > self.version).all()
+            new_ids = [club.id for club in changed if club.id not in self.fragments]
+            for club in changed:
+                self.fragments[club.id] = self.encode(club)
+            if new_ids:
+                # Readers may be slicing the old list, so it is replaced rather than changed in place.
+                self.ids = sorted(self.ids + new_ids)
+            self.version = version
+            self.updates += len(changed)
+
+    def rebuild(self, version):
+        fragments = {club.id: self.encode(club) for club in clubs_query().yield_per(STREAM_BATCH_SIZE)}
+        self.fragments = fragments
+        self.ids = list(fragments)
+        self.version = version
+        self.rebuilds += 1
+
+    # Returns one page of club ids in id order, like paginate() over every club, and the cursor for
+    # the next page.
+    def page_ids(self, limit=None, after=None):
+        ids = self.ids
+        start = bisect.bisect_right(ids, after) if after is not None else 0
+        if limit is None:
+            return ids[start:], None
+        page = ids[start:start + limit]
+        return page, page[-1] if start + limit < len(ids) else None
+
+    # Streams the clubs with the given ids, in that order, as the list endpoint's response.
+    def response(self, ids, next_cursor=None):
+        fragments = self.fragments
+        return stream_encoded((fragments[club_id] for club_id in ids if club_id in fragments), next_cursor)
+
+    # Number of clubs and total size of their fragments in bytes.
+    def stats(self):
+        return {"clubs": len(self.fragments), "bytes": sum(len(fragment) for fragment in self.fragments.values())}
+
+
+club_fragments = ClubFragments()
@@ -0,0 +1,175 @@
+import atexit
+import queue
+import signal
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import func, insert, select
+
+from cache import cache
+from db import db, retry_on_busy
+from models import *
+from trending import record_comments, utcnow
+from versions import bump
+
+# Opt-in write-behind mode for new comments and replies (COMMENT_WRITE_BEHIND = True).
+# The endpoints validate the request, take the next comment id from this process and queue the row,
+# answering 202 Accepted right away. A single background thread writes queued comments in batches,
+# one INSERT and one commit per batch (a group commit), so a burst of comments costs a few fsyncs
+# instead of one each. Until its batch is committed a comment is readable through
+# GET /api/comments/<id>, which is how clients read their own writes.
+# Comment ids are handed out in memory, so only one process may write comments while this is on.
+
+# Number of recently failed comment ids to remember for GET /api/comments/<id>.
+MAX_FAILED = 1000
+
+
+class QueueFull(Exception):
+    pass
+
+
+class CommentQueue:
+    def __init__(self):
+        self.app = None
+        self.enabled = False
+        self.queue = None
+        self.pending = {}
+        self.failed = OrderedDict()
+        self.next_id = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self.rejected = 0
+
+    # Reads the settings from the app config:
+    # COMMENT_WRITE_BEHIND turns the mode on (off by default), COMMENT_QUEUE_SIZE bounds the number of
+    # queued comments, past which the endpoints answer 503, COMMENT_BATCH_SIZE is the most comments
+    # written per commit and COMMENT_FLUSH_INTERVAL is how many seconds the writer waits for a batch
+    # to fill up.
+    # The writer thread and its shutdown hooks are started here rather than on the first comment, since
+    # a SIGTERM handler can only be installed from the main thread, not from a request thread.
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("COMMENT_WRITE_BEHIND", False)
+        self.batch_size = app.config.get("COMMENT_BATCH_SIZE", 500)
+        self.flush_interval = app.config.get("COMMENT_FLUSH_INTERVAL", 0.05)
+        self.queue = queue.Queue(app.config.get("COMMENT_QUEUE_SIZE", 10000))
+        if self.enabled:
+            self.start()
+
+    # Starts the writer thread, and makes sure it writes out the queue when the process exits.
+    # Call from the main thread.
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="comment-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+        # SIGTERM normally ends the process without running atexit handlers.
+        if threading.current_thread() is threading.main_thread() and signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, exit_on_sigterm)
+
+    # Waits until every queued comment has been written, then stops the writer thread.
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        self.stopping.clear()
+
+    # Queues a new comment by user (anything with id and username) on club and returns its id.
+    # Raises QueueFull when the queue is at COMMENT_QUEUE_SIZE.
+    def submit(self, user, club, text, parent_comment_id=None):
+        with self.lock:
+            if self.next_id is None:
+                self.next_id = (db.session.execute(select(func.max(Comment.id))).scalar() or 0) + 1
+            if self.queue.full():
+                self.rejected += 1
+                raise QueueFull()
+            comment_id = self.next_id
+            self.next_id += 1
+            timestamp = utcnow()
+            row = {"id": comment_id, "user_id": user.id, "club_id": club.id, "parent_comment_id": parent_comment_id,
+                   "text": text, "timestamp": timestamp}
+            self.pending[comment_id] = {
+                "row": row,
+                "comment": {"id": comment_id, "user": user.username, "club": club.name,
+                            "parent_comment_id": parent_comment_id, "text": text, "timestamp": timestamp},
+                "groups": [f"club_comments:{club.code}", f"user_comments:{user.id}"],
+            }
+            self.queue.put_nowait(comment_id)
+            return comment_id
+
+    # Returns the queued row of a comment that hasn't been written yet, or None.
+    def pending_row(self, comment_id):
+        entry = self.pending.get(comment_id)
+        return entry["row"] if entry else None
+
+    # Returns ("pending", comment dict) for a queued comment, ("failed", error message) for one that
+    # couldn't be written, and (None, None) otherwise.
+    def status(self, comment_id):
+        entry = self.pending.get(comment_id)
+        if entry is not None:
+            return "pending", entry["comment"]
+        if comment_id in self.failed:
+            return "failed", self.failed[comment_id]
+        return None, None
+
+    def run(self):
+        with self.app.app_context():
+            while True:
+                try:
+                    batch = [self.queue.get(timeout=0.2)]
+                except queue.Empty:
+                    if self.stopping.is_set():
+                        return
+                    continue
+                # Gather more comments for the same commit, without waiting once shutting down.
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.queue.get(timeout=0 if self.stopping.is_set() else self.flush_interval))
+                    except queue.Empty:
+                        break
+                self.write(batch)
+
+    # Writes a batch of queued comments in one transaction. If the batch can't be written, its comments
+    # are retried one by one so a bad row only loses itself.
+    def write(self, comment_ids):
+        entries = [self.pending[comment_id] for comment_id in comment_ids]
+        try:
+            insert_comments([entry["row"] for entry in entries])
+        except Exception as e:
+            db.session.rollback()
+            if len(comment_ids) > 1:
+                for comment_id in comment_ids:
+                    self.write([comment_id])
+                return
+            self.failed[comment_ids[0]] = str(e)
+            while len(self.failed) > MAX_FAILED:
+                self.failed.popitem(last=False)
+            self.pending.pop(comment_ids[0], None)
+            return
+
+        self.batches += 1
+        self.written += len(comment_ids)
+        cache.invalidate(*dict.fromkeys(group for entry in entries for group in entry["groups"]))
+        for comment_id in comment_ids:
+            self.pending.pop(comment_id, None)
+
+
+def exit_on_sigterm(signum, frame):
+    raise SystemExit(0)
+
+
+@retry_on_busy
+def insert_comments(rows):
+    db.session.execute(insert(Comment.__table__), rows)
+    record_comments((row["club_id"], row["timestamp"]) for row in rows)
+    bump("comments")
+    db.session.commit()
+
+
+comment_queue = CommentQueue()
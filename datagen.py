@@ -0,0 +1,173 @@
+import datetime
+import itertools
+import random
+
+from sqlalchemy import func, insert, select
+from werkzeug.security import generate_password_hash
+
+from db import db
+from favorites import reconcile_favorites
+from models import *
+from passwords import hasher
+from search import create_search_index, rebuild_search_index
+from tag_stats import rebuild_tag_stats
+from trending import rebuild_trending, utcnow
+from versions import bump
+
+# Synthetic data for benchmarks and load tests: clubs with tags, users, favorites and threaded comments,
+# at any size, written with bulk inserts. The same seed always produces the same data.
+# Popularity is skewed like real traffic: a few clubs get most of the favorites and comments, and
+# replies go to recent comments, so threads nest several levels deep.
+# Fill an empty database with `python manage.py generate --clubs 10000 --users 5000 ...`.
+
+WORDS = [
+    "penn", "pre", "professional", "juggling", "organization", "lorem", "ipsum", "memes", "program",
+    "potential", "procrastinators", "locust", "labs", "robotics", "chess", "debate", "dance", "music",
+    "finance", "consulting", "coding", "hiking", "cooking", "film", "photography", "poetry", "theater",
+    "society", "association", "club", "team", "league", "union", "guild", "circle", "collective",
+]
+SYLLABLES = ["ba", "ke", "lo", "mi", "nu", "ra", "si", "to", "ve", "zu", "qua", "dro", "fen", "gal", "hor", "pil"]
+
+# Password of every generated user (user1, user2, ...).
+PASSWORD = "password"
+
+# Replies go to one of this many most recent comments.
+REPLY_WINDOW = 1000
+
+
+# Builds a vocabulary of the hand picked WORDS plus n synthetic ones, with Zipf-like weights
+# so a few words are very common and most are rare, as in real club descriptions.
+def vocabulary(rng, n=20000):
+    words = WORDS + ["".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) for _ in range(n)]
+    return words, zipf_weights(len(words))
+
+
+def random_text(rng, vocab, n_words):
+    words, cum_weights = vocab
+    return " ".join(rng.choices(words, cum_weights=cum_weights, k=n_words))
+
+
+# Cumulative Zipf weights for n items: item k is picked about 1/k times as often as the first.
+def zipf_weights(n):
+    return list(itertools.accumulate(1 / rank for rank in range(1, n + 1)))
+
+
+# Club ids from most to least popular, in an order that doesn't follow the ids, and their weights.
+def popularity(rng, n_clubs):
+    club_ids = list(range(1, n_clubs + 1))
+    rng.shuffle(club_ids)
+    return club_ids, zipf_weights(n_clubs)
+
+
+# Inserts n_clubs synthetic clubs with up to 4 tags each out of n_tags, using bulk inserts.
+def generate_clubs(n_clubs, n_tags, seed=0, batch_size=10000):
+    rng = random.Random(seed)
+    vocab = vocabulary(rng)
+    db.session.execute(insert(Tag), [{"id": i, "name": f"tag-{i}"} for i in range(1, n_tags + 1)])
+    for start in range(1, n_clubs + 1, batch_size):
+        ids = range(start, min(start + batch_size, n_clubs + 1))
+        db.session.execute(insert(Club), [
+            {"id": i, "code": f"club-{i}", "name": f"{random_text(rng, vocab, 3)} {i}".title(),
+             "description": random_text(rng, vocab, 25), "favorites": 0}
+            for i in ids
+        ])
+        db.session.execute(insert(clubs_to_tags), [
+            {"club_id": i, "tag_id": tag_id}
+            for i in ids for tag_id in rng.sample(range(1, n_tags + 1), min(n_tags, rng.randint(1, 4)))
+        ])
+    db.session.commit()
+
+
+# Inserts n_users users named user1, user2, ... who all log in with PASSWORD. The password is hashed
+# once and shared, since hashing it per user would take longer than everything else.
+def generate_users(n_users, batch_size=10000):
+    password_hash = generate_password_hash(PASSWORD, hasher.method)
+    schools = ["SEAS", "Wharton", "College", "Nursing"]
+    for start in range(1, n_users + 1, batch_size):
+        db.session.execute(insert(User), [
+            {"id": i, "username": f"user{i}", "email": f"user{i}@upenn.edu", "password_hash": password_hash,
+             "first_name": "Test", "last_name": f"User{i}", "school": schools[i % len(schools)], "major": "CIS",
+             "grad_year": 2025 + i % 4}
+            for i in range(start, min(start + batch_size, n_users + 1))
+        ])
+    db.session.commit()
+
+
+# Gives every user between 0 and twice per_user favorite clubs, mostly popular ones, made at random
+# times over the last days days, and sets each club's favorites count to match.
+def generate_favorites(n_users, n_clubs, per_user, days=30, seed=0, batch_size=10000):
+    rng = random.Random(seed)
+    club_ids, cum_weights = popularity(random.Random(seed), n_clubs)
+    now = utcnow()
+    rows = []
+    for user_id in range(1, n_users + 1):
+        count = min(n_clubs, rng.randint(0, 2 * per_user))
+        for club_id in set(rng.choices(club_ids, cum_weights=cum_weights, k=count)):
+            created_at = now - datetime.timedelta(days=days) * rng.random()
+            rows.append({"user_id": user_id, "club_id": club_id, "created_at": created_at})
+        if len(rows) >= batch_size:
+            db.session.execute(insert(user_to_favorite_club), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(user_to_favorite_club), rows)
+    reconcile_favorites()
+    db.session.commit()
+
+
+# Inserts n_comments comments spread over the last days days, oldest first. About reply_ratio of them
+# reply to one of the REPLY_WINDOW most recent comments (on that comment's club); the rest start a new
+# thread on a club picked by popularity. Authors are picked uniformly from the users.
+def generate_comments(n_comments, n_users, n_clubs, reply_ratio=0.3, days=30, seed=0, batch_size=10000):
+    rng = random.Random(seed)
+    vocab = vocabulary(rng)
+    club_ids, cum_weights = popularity(random.Random(seed), n_clubs)
+    # The club of every comment so far, indexed by comment id, for placing replies.
+    club_of = [0]
+    now = utcnow()
+    start_time = now - datetime.timedelta(days=days)
+    step = datetime.timedelta(days=days) / max(n_comments, 1)
+    rows = []
+    for comment_id in range(1, n_comments + 1):
+        parent_id = None
+        if comment_id > 1 and rng.random() < reply_ratio:
+            parent_id = rng.randint(max(1, comment_id - REPLY_WINDOW), comment_id - 1)
+            club_id = club_of[parent_id]
+        else:
+            club_id = rng.choices(club_ids, cum_weights=cum_weights)[0]
+        club_of.append(club_id)
+        rows.append({"id": comment_id, "user_id": rng.randint(1, n_users), "club_id": club_id,
+                     "parent_comment_id": parent_id, "text": random_text(rng, vocab, rng.randint(5, 40)),
+                     "timestamp": start_time + step * comment_id})
+        if len(rows) == batch_size:
+            db.session.execute(insert(Comment), rows)
+            rows = []
+    if rows:
+        db.session.execute(insert(Comment), rows)
+    db.session.commit()
+
+
+# Fills an empty database with a full synthetic data set and brings the derived data (tag counts,
+# favorite counts, the search index and the trending rollups) up to date. Raises ValueError if there are clubs or users already.
+# Returns the number of rows generated per table.
+def generate(clubs, tags, users, favorites_per_user=5, comments=0, reply_ratio=0.3, days=30, seed=0):
+    if db.session.execute(select(func.count()).select_from(Club)).scalar() or \
+            db.session.execute(select(func.count()).select_from(User)).scalar():
+        raise ValueError("Synthetic data can only be generated into an empty database")
+    create_search_index()
+    generate_clubs(clubs, tags, seed)
+    generate_users(users)
+    if users and clubs:
+        generate_favorites(users, clubs, favorites_per_user, days, seed)
+        generate_comments(comments, users, clubs, reply_ratio, days, seed)
+    rebuild_tag_stats()
+    rebuild_search_index()
+    rebuild_trending()
+    bump("club", "tag", "user", "comments", "favorites")
+    db.session.commit()
+    return {
+        "clubs": clubs,
+        "tags": tags,
+        "users": users,
+        "favorites": db.session.execute(select(func.count()).select_from(user_to_favorite_club)).scalar(),
+        "comments": comments if users and clubs else 0,
+    }
@@ -1,3 +1,106 @@
+import random
+import time
+from functools import partial, wraps
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, insert
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import OperationalError
+
+db = SQLAlchemy()
+
+# Engine profiles for SQLite databases, picked with the DB_PROFILE config value.
+# "default" keeps SQLite's stock settings. "tuned" switches to WAL so readers no longer block behind
+# the writer, only fsyncs at checkpoints (synchronous=NORMAL, which is still crash safe in WAL mode),
+# memory maps up to 256 MB of the file, keeps 64 MB of pages cached per connection and waits longer
+# for the write lock before giving up. pool_size and max_overflow size the connection pool.
+SQLITE_PROFILES = {
+    "default": {
+        "pragmas": {},
+        "timeout": 5,
+        "pool_size": 5,
+        "max_overflow": 10,
+    },
+    "tuned": {
+        "pragmas": {"journal_mode": "WAL", "synchronous": "NORMAL", "mmap_size": 256 * 2**20,
+                    "cache_size": -64 * 1024, "temp_store": "MEMORY"},
+        "timeout": 15,
+        "pool_size": 10,
+        "max_overflow": 20,
+    },
+}
+
+# How many times retry_on_busy runs a view before letting "database is locked" through,
+# and the delay before the first retry in seconds. Later retries back off exponentially.
+BUSY_ATTEMPTS = 5
+BUSY_BASE_DELAY = 0.02
+
+busy_stats = {"retries": 0, "failures": 0}
+
+
+def sqlite_profile(app):
+    url = make_url(app.config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    return SQLITE_PROFILES[app.config.get("DB_PROFILE", "tuned")]
+
+
+def set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+# Binds db to the app's database. File based SQLite databases get the connection pool and pragmas of
+# the profile named by DB_PROFILE; any engine options set in SQLALCHEMY_ENGINE_OPTIONS take precedence.
+def init_db_engine(app):
+    profile = sqlite_profile(app)
+    if profile is not None:
+        options = {"pool_size": profile["pool_size"], "max_overflow": profile["max_overflow"],
+                   "connect_args": {"timeout": profile["timeout"]}}
+        options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}))
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    db.init_app(app)
+    if profile is not None and profile["pragmas"]:
+        with app.app_context():
+            event.listen(db.engine, "connect", partial(set_pragmas, profile["pragmas"]))
+
+
+def is_busy(error):
+    message = str(error.orig)
+    return "database is locked" in message or "database is busy" in message
+
+
+# Runs the decorated view again when SQLite reports the database as locked, after rolling back and
+# sleeping for an exponentially growing, jittered delay. Only for views whose side effects all happen
+# in the database transaction or after it commits, so a retry starts from a clean slate.
+def retry_on_busy(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        for attempt in range(BUSY_ATTEMPTS):
+            try:
+                return f(*args, **kwargs)
+            except OperationalError as e:
+                db.session.rollback()
+                if not is_busy(e):
+                    raise
+                if attempt == BUSY_ATTEMPTS - 1:
+                    busy_stats["failures"] += 1
+                    raise
+                busy_stats["retries"] += 1
+                time.sleep(BUSY_BASE_DELAY * 2 ** attempt * (0.5 + random.random()))
+
+    return decorated
+
 
-db = SQLAlchemy()
\ No newline at end of file
+# INSERT that silently skips rows which would violate a unique or primary key constraint.
+def insert_or_ignore(table):
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "sqlite":
+        return sqlite.insert(table).on_conflict_do_nothing()
+    if dialect == "postgresql":
+        return postgresql.insert(table).on_conflict_do_nothing()
+    # MySQL and MariaDB
+    return insert(table).prefix_with("IGNORE")
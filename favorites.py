@@ -0,0 +1,57 @@
+from sqlalchemy import case, delete, func, select, update
+
+from db import db, insert_or_ignore
+from models import *
+from trending import record_favorite, utcnow
+
+# Favorite/unfavorite as single statements, without loading the user's favorites collection.
+# The association row is inserted with INSERT ... ON CONFLICT DO NOTHING (or deleted), and Club.favorites
+# is moved with an atomic UPDATE ... SET favorites = favorites + 1 only when a row actually changed,
+# so concurrent requests can't double count or lose updates.
+# reconcile_favorites() recomputes the denormalized counts from user_to_favorite_club.
+# Each favorite records when it was made, and both functions record the change in the trending rollups.
+
+
+# Adds the club to the user's favorites. Returns True if it wasn't already a favorite.
+# Does not commit.
+def add_favorite(user_id, club_id):
+    created_at = utcnow()
+    result = db.session.execute(
+        insert_or_ignore(user_to_favorite_club).values(user_id=user_id, club_id=club_id, created_at=created_at)
+    )
+    if result.rowcount != 1:
+        return False
+    db.session.execute(update(Club).where(Club.id == club_id).values(favorites=Club.favorites + 1))
+    record_favorite(club_id, created_at, 1)
+    return True
+
+
+# Removes the club from the user's favorites. Returns True if it was a favorite.
+# Does not commit.
+def remove_favorite(user_id, club_id):
+    favorite = (user_to_favorite_club.c.user_id == user_id, user_to_favorite_club.c.club_id == club_id)
+    created_at = db.session.execute(select(user_to_favorite_club.c.created_at).where(*favorite)).scalar()
+    result = db.session.execute(delete(user_to_favorite_club).where(*favorite))
+    if result.rowcount != 1:
+        return False
+    db.session.execute(
+        update(Club).where(Club.id == club_id)
+        .values(favorites=case((Club.favorites > 0, Club.favorites - 1), else_=0))
+    )
+    record_favorite(club_id, created_at, -1)
+    return True
+
+
+# Sets every club's favorites to the number of users who favorited it.
+# Returns the number of clubs whose count was wrong. Does not commit.
+def reconcile_favorites():
+    actual = (
+        select(func.count())
+        .select_from(user_to_favorite_club)
+        .where(user_to_favorite_club.c.club_id == Club.id)
+        .scalar_subquery()
+    )
+    result = db.session.execute(
+        update(Club).where(func.coalesce(Club.favorites, -1) != actual).values(favorites=actual)
+    )
+    return result.rowcount
@@ -0,0 +1,168 @@
+import json
+import time
+from collections import Counter
+
+from sqlalchemy import func, insert, select
+
+from db import db
+from models import *
+from search import rebuild_search_index
+from tag_stats import apply_tag_deltas
+from versions import bump
+
+# Bulk loader for club dumps, used by bootstrap.py and `python manage.py load`.
+# Input is read incrementally, either a JSON array of club objects (like clubs.json) or JSONL with
+# one club object per line, so memory stays flat no matter how big the dump is.
+# Tags are resolved through an in-memory name -> id dictionary and clubs, tags and clubs_to_tags rows
+# are written with multi-row INSERTs, batch_size clubs at a time, all inside a single transaction.
+# Clubs whose code already exists are skipped.
+
+
+# Yields the objects of a top level JSON array without reading the whole file into memory.
+# Expects an array of objects (or strings/arrays), which can't be cut short at a chunk boundary.
+def iter_json_array(file, chunk_size=1 << 16):
+    decoder = json.JSONDecoder()
+    buffer, pos = "", 0
+    expected = "["
+    while True:
+        # Skip whitespace, reading more input whenever the buffer runs out.
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer):
+                break
+            chunk = file.read(chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of JSON input")
+            buffer, pos = chunk, 0
+
+        char = buffer[pos]
+        if expected == "[":
+            if char != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            expected = "value or ]"
+            continue
+        if char == "]" and expected in ("value or ]", ", or ]"):
+            return
+        if expected == ", or ]":
+            if char != ",":
+                raise ValueError(f"Expected , or ] at position {pos}")
+            pos += 1
+            expected = "value"
+            continue
+
+        # Decode the next value, pulling in more input until it is complete.
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                break
+            except json.JSONDecodeError:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer, pos = buffer[pos:] + chunk, 0
+        yield item
+        pos = end
+        expected = ", or ]"
+        if pos > chunk_size:
+            buffer, pos = buffer[pos:], 0
+
+
+def iter_jsonl(file):
+    for line in file:
+        if line.strip():
+            yield json.loads(line)
+
+
+# Yields the club records in a dump. fmt is "json" or "jsonl"; by default it is guessed from the file name.
+def iter_clubs(path, fmt=None):
+    if fmt is None:
+        fmt = "jsonl" if path.endswith((".jsonl", ".ndjson")) else "json"
+    with open(path, "r") as file:
+        if fmt == "jsonl":
+            yield from iter_jsonl(file)
+        else:
+            yield from iter_json_array(file)
+
+
+def batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Inserts one batch of club records. tag_ids and codes are updated in place with the new tags and clubs,
+# and tag_counts with the number of clubs added to each tag id.
+# Returns the number of (clubs, tags, club-tag links) inserted.
+def insert_batch(batch, tag_ids, codes, tag_counts):
+    clubs = []
+    for club_data in batch:
+        if club_data["code"] in codes:
+            continue
+        codes.add(club_data["code"])
+        clubs.append(club_data)
+    if not clubs:
+        return 0, 0, 0
+
+    # Plain executemany INSERTs followed by one SELECT for the new ids. SQLite can't return ids from a
+    # batched INSERT ... RETURNING in parameter order, so asking for them would send one INSERT per row.
+    new_tags = list(dict.fromkeys(tag for club_data in clubs for tag in club_data["tags"] if tag not in tag_ids))
+    if new_tags:
+        db.session.execute(insert(Tag), [{"name": name} for name in new_tags])
+        tag_ids.update(db.session.execute(select(Tag.name, Tag.id).where(Tag.name.in_(new_tags))).all())
+
+    db.session.execute(insert(Club), [
+        {"code": club_data["code"], "name": club_data["name"], "description": club_data["description"],
+         "favorites": 0} for club_data in clubs
+    ])
+    club_ids = dict(db.session.execute(
+        select(Club.code, Club.id).where(Club.code.in_([club_data["code"] for club_data in clubs]))
+    ).all())
+
+    links = [
+        {"club_id": club_ids[club_data["code"]], "tag_id": tag_ids[tag]}
+        for club_data in clubs for tag in dict.fromkeys(club_data["tags"])
+    ]
+    if links:
+        db.session.execute(insert(clubs_to_tags), links)
+        tag_counts.update(link["tag_id"] for link in links)
+    return len(clubs), len(new_tags), len(links)
+
+
+# Loads club records into the database in a single transaction and returns load statistics.
+def load_clubs(records, batch_size=1000):
+    t0 = time.perf_counter()
+    tag_ids = dict(db.session.execute(select(Tag.name, Tag.id)).all())
+    codes = set(db.session.execute(select(Club.code)).scalars())
+    last_id = db.session.execute(select(func.max(Club.id))).scalar() or 0
+    tag_counts = Counter()
+    stats = {"clubs": 0, "tags": 0, "club_tags": 0}
+    try:
+        for batch in batches(records, batch_size):
+            clubs, tags, links = insert_batch(batch, tag_ids, codes, tag_counts)
+            stats["clubs"] += clubs
+            stats["tags"] += tags
+            stats["club_tags"] += links
+        apply_tag_deltas(tag_counts)
+        rebuild_search_index(after_id=last_id)
+        bump("club", "tag")
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    stats["rows"] = stats["clubs"] + stats["tags"] + stats["club_tags"]
+    stats["seconds"] = time.perf_counter() - t0
+    stats["rows_per_second"] = stats["rows"] / stats["seconds"] if stats["seconds"] else 0
+    return stats
+
+
+def format_stats(stats):
+    return (f"Loaded {stats['clubs']} clubs, {stats['tags']} new tags and {stats['club_tags']} club tags "
+            f"in {stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/sec)")
@@ -0,0 +1,151 @@
+import argparse
+
+from app import app, init_db
+from cache import cache
+from datagen import generate
+from db import db
+from favorites import reconcile_favorites
+from loader import format_stats, iter_clubs, load_clubs
+from migrations import migrate
+from query_plans import check_query_counts, check_query_plans
+from tag_stats import check_tag_stats, rebuild_tag_stats
+from trending import compact_trending, rebuild_trending
+from versions import bump
+
+# Maintenance commands for the Penn Club Review database. Each command runs inside an app context
+# against the database configured in app.py. Usage: `python manage.py <command> [options]`.
+
+
+# Streams a JSON array or JSONL dump of clubs into the database.
+def load(args):
+    init_db()
+    stats = load_clubs(iter_clubs(args.path, args.format), batch_size=args.batch_size)
+    cache.invalidate("tags")
+    print(format_stats(stats))
+
+
+# Fills an empty database with synthetic clubs, tags, users, favorites and comments (see datagen.py).
+def generate_data(args):
+    migrate()
+    try:
+        counts = generate(args.clubs, args.tags, args.users, args.favorites, args.comments, seed=args.seed)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    init_db()
+    cache.invalidate("tags")
+    print(f"Generated {', '.join(f'{count} {table}' for table, count in counts.items())}")
+
+
+# Recomputes Club.favorites from the user_to_favorite_club association table.
+def reconcile(args):
+    fixed = reconcile_favorites()
+    if fixed:
+        bump("favorites")
+    db.session.commit()
+    print(f"Corrected the favorites count of {fixed} clubs")
+
+
+# Recomputes the tag_stats table from clubs_to_tags.
+def rebuild_tags(args):
+    rebuild_tag_stats()
+    bump("tag")
+    db.session.commit()
+    cache.invalidate("tags")
+    print("Rebuilt tag statistics")
+
+
+# Fails if any stored tag count differs from the live aggregate over clubs_to_tags.
+def check_tags(args):
+    mismatches = check_tag_stats()
+    for name, stored, actual in mismatches:
+        print(f"{name}: stored {stored}, actual {actual}")
+    if mismatches:
+        raise SystemExit(1)
+    print("Tag statistics are consistent")
+
+
+# Moves the trending windows forward to the current hour and deletes expired activity buckets.
+# Meant to run periodically, e.g. from cron every few minutes.
+def compact_trending_windows(args):
+    if compact_trending():
+        db.session.commit()
+        print("Compacted trending windows")
+    else:
+        print("Trending windows are up to date")
+
+
+# Recomputes the trending rollups from comment timestamps and favorite times.
+def rebuild_trending_windows(args):
+    rebuild_trending()
+    db.session.commit()
+    print("Rebuilt trending windows")
+
+
+# Applies pending schema migrations to the configured database.
+def run_migrations(args):
+    ran = migrate()
+    if ran:
+        cache.invalidate("tags")
+    print(f"Applied migrations: {', '.join(ran)}" if ran else "Database is up to date")
+
+
+# Fails if any read endpoint query falls back to a full table scan.
+def check_plans(args):
+    problems = check_query_plans(app)
+    for url, tables in problems.items():
+        print(f"{url}: full scan of {', '.join(sorted(tables))}")
+    over_budget = check_query_counts(app)
+    for url, message in over_budget.items():
+        print(f"{url}: {message}")
+    if problems or over_budget:
+        raise SystemExit(1)
+    print("No unexpected full table scans or extra queries")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Penn Club Review maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    load_parser = subparsers.add_parser("load", help="bulk load clubs from a JSON or JSONL dump")
+    load_parser.add_argument("path", help="file with a JSON array of clubs, or one club per line")
+    load_parser.add_argument("--format", choices=["json", "jsonl"], help="defaults to the file extension")
+    load_parser.add_argument("--batch-size", type=int, default=1000, help="clubs per INSERT batch")
+    load_parser.set_defaults(func=load)
+
+    generate_parser = subparsers.add_parser("generate", help="fill an empty database with synthetic data")
+    generate_parser.add_argument("--clubs", type=int, default=10000)
+    generate_parser.add_argument("--tags", type=int, default=200)
+    generate_parser.add_argument("--users", type=int, default=5000)
+    generate_parser.add_argument("--favorites", type=int, default=5, help="average favorite clubs per user")
+    generate_parser.add_argument("--comments", type=int, default=100000)
+    generate_parser.add_argument("--seed", type=int, default=0)
+    generate_parser.set_defaults(func=generate_data)
+
+    reconcile_parser = subparsers.add_parser("reconcile-favorites", help="recompute club favorite counts")
+    reconcile_parser.set_defaults(func=reconcile)
+
+    rebuild_tags_parser = subparsers.add_parser("rebuild-tag-stats", help="recompute the club count of every tag")
+    rebuild_tags_parser.set_defaults(func=rebuild_tags)
+
+    check_tags_parser = subparsers.add_parser("check-tag-stats", help="fail if a stored tag count is wrong")
+    check_tags_parser.set_defaults(func=check_tags)
+
+    compact_parser = subparsers.add_parser("compact-trending", help="expire old trending activity buckets")
+    compact_parser.set_defaults(func=compact_trending_windows)
+
+    rebuild_trending_parser = subparsers.add_parser("rebuild-trending", help="recompute the trending rollups")
+    rebuild_trending_parser.set_defaults(func=rebuild_trending_windows)
+
+    migrate_parser = subparsers.add_parser("migrate", help="apply pending schema migrations")
+    migrate_parser.set_defaults(func=run_migrations)
+
+    plans_parser = subparsers.add_parser("check-plans", help="fail if an endpoint query does a full table scan or an endpoint sends too many queries")
+    plans_parser.set_defaults(func=check_plans)
+
+    args = parser.parse_args()
+    with app.app_context():
+        args.func(args)
+
+
+if __name__ == "__main__":
+    main()
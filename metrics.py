@@ -0,0 +1,211 @@
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, has_app_context, request
+from sqlalchemy import event
+
+from cache import cache
+from club_fragments import club_fragments
+from comment_queue import comment_queue
+from db import busy_stats, db
+from passwords import hasher
+
+# Request metrics, exposed in the Prometheus text format at GET /metrics.
+# Flask's before/after request hooks time every request, and SQLAlchemy engine events count the SQL
+# statements it runs and the time spent in them, including statements run while a streamed response is
+# being sent. Requests are recorded per route (the URL rule, e.g. /api/clubs/<string:code>, so club
+# codes don't each get their own series) in histograms of latency, SQL statement count, SQL time and
+# response size.
+# With SLOW_REQUEST_MS set, requests slower than that are logged with their slowest SQL statements.
+
+# Histogram bucket upper bounds.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENTS_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+BYTES_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# Number of statements, slowest first, included in a slow request log entry.
+SLOW_REQUEST_STATEMENTS = 10
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    # Prometheus sample lines for this histogram, with the given labels (a "key=\"value\"" string).
+    def samples(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:g}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+# What is measured about one request while it runs.
+class RequestMetrics:
+    def __init__(self, keep_statements):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0
+        self.size = 0
+        self.statements = [] if keep_statements else None
+
+
+class Metrics:
+    def __init__(self):
+        self.app = None
+        self.enabled = True
+        self.slow_request_ms = None
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.histograms = {}
+
+    # Reads the settings from the app config and registers the hooks:
+    # METRICS_ENABLED turns recording on (the default) or off and SLOW_REQUEST_MS is the duration in
+    # milliseconds past which a request is logged with its SQL (off by default).
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("METRICS_ENABLED", True)
+        self.slow_request_ms = app.config.get("SLOW_REQUEST_MS")
+        if not self.enabled:
+            return
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+            event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
+
+    def before_request(self):
+        g.request_metrics = RequestMetrics(keep_statements=self.slow_request_ms is not None)
+
+    # Records the request. Streamed responses are recorded once their body has been sent, so their time,
+    # SQL and size are measured in full.
+    def after_request(self, response):
+        state = g.get("request_metrics")
+        if state is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        method = request.method
+        status = response.status_code
+        if response.is_streamed:
+            response.response = self.count_bytes(response.response, state, route, method, status)
+        else:
+            state.size = response.calculate_content_length() or 0
+            self.record(state, route, method, status)
+        return response
+
+    # Passes the chunks of a streamed body through, adding up their size, and records the request at the end.
+    def count_bytes(self, chunks, state, route, method, status):
+        try:
+            for chunk in chunks:
+                state.size += len(chunk.encode() if isinstance(chunk, str) else chunk)
+                yield chunk
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            self.record(state, route, method, status)
+
+    def record(self, state, route, method, status):
+        seconds = time.perf_counter() - state.start
+        with self.lock:
+            self.requests[(route, method, str(status))] += 1
+            for name, buckets, value in (
+                ("http_request_duration_seconds", SECONDS_BUCKETS, seconds),
+                ("http_request_sql_statements", STATEMENTS_BUCKETS, state.sql_count),
+                ("http_request_sql_seconds", SECONDS_BUCKETS, state.sql_seconds),
+                ("http_response_size_bytes", BYTES_BUCKETS, state.size),
+            ):
+                key = (name, route, method)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(buckets)
+                self.histograms[key].observe(value)
+        if self.slow_request_ms is not None and seconds * 1000 >= self.slow_request_ms:
+            self.log_slow_request(state, route, method, status, seconds)
+
+    def log_slow_request(self, state, route, method, status, seconds):
+        slowest = sorted(state.statements, key=lambda statement: statement[1], reverse=True)
+        lines = [f"Slow request: {method} {route} {status} took {seconds * 1000:.0f} ms, "
+                 f"{state.sql_count} SQL statements in {state.sql_seconds * 1000:.0f} ms"]
+        lines += [f"  {duration * 1000:8.2f} ms  {statement}" for statement, duration in slowest[:SLOW_REQUEST_STATEMENTS]]
+        self.app.logger.warning("\n".join(lines))
+
+    # The metrics in the Prometheus text exposition format.
+    def render(self):
+        lines = ["# HELP http_requests_total Requests served, by route, method and status.",
+                 "# TYPE http_requests_total counter"]
+        with self.lock:
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+            for name, help_text in (
+                ("http_request_duration_seconds", "Time to serve a request, including sending a streamed body."),
+                ("http_request_sql_statements", "SQL statements run per request."),
+                ("http_request_sql_seconds", "Time spent running SQL statements per request."),
+                ("http_response_size_bytes", "Size of the response body."),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for (histogram_name, route, method), histogram in sorted(self.histograms.items()):
+                    if histogram_name == name:
+                        lines += histogram.samples(name, f'route="{route}",method="{method}"')
+
+        counters = [
+            ("cache_hits_total", "Response cache hits.", cache.hits),
+            ("cache_misses_total", "Response cache misses.", cache.misses),
+            ("cache_evictions_total", "Response cache entries evicted to make room.", cache.stats()["evictions"]),
+            ("cache_invalidations_total", "Response cache groups invalidated.", cache.invalidations),
+            ("db_busy_retries_total", "Writes retried because the database was locked.", busy_stats["retries"]),
+            ("db_busy_failures_total", "Writes that gave up on a locked database.", busy_stats["failures"]),
+            ("password_hashes_rejected_total", "Logins rejected because too many hashes were pending.",
+             hasher.rejected),
+            ("comment_queue_batches_total", "Batches of queued comments written.", comment_queue.batches),
+            ("comment_queue_written_total", "Queued comments written.", comment_queue.written),
+            ("comment_queue_rejected_total", "Comments rejected because the queue was full.", comment_queue.rejected),
+            ("club_fragments_rebuilds_total", "Full builds of the pre-encoded club fragments.", club_fragments.rebuilds),
+            ("club_fragments_updates_total", "Club fragments re-encoded after a change.", club_fragments.updates),
+        ]
+        for name, help_text, value in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+        lines += ["# HELP comment_queue_pending Comments queued and not yet written.",
+                  "# TYPE comment_queue_pending gauge", f"comment_queue_pending {len(comment_queue.pending)}"]
+        return "\n".join(lines) + "\n"
+
+
+# The RequestMetrics of the current request, or None outside a request, e.g. in the comment writer thread.
+def current_request_metrics():
+    return g.get("request_metrics") if has_app_context() else None
+
+
+# Engine event hooks that time each statement run for a request.
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_request_metrics() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = current_request_metrics()
+    starts = conn.info.get("query_start")
+    if state is None or not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    state.sql_count += 1
+    state.sql_seconds += duration
+    if state.statements is not None:
+        state.statements.append((statement, duration))
+
+
+metrics = Metrics()
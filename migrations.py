@@ -0,0 +1,101 @@
+from functools import partial
+
+from sqlalchemy import delete, func, insert, inspect, literal, select, text
+
+from db import db, insert_or_ignore
+from models import *
+from tag_stats import rebuild_tag_stats
+from trending import rebuild_trending
+
+# In-place schema migrations for existing databases (e.g. an old instance/clubreview.db).
+# db.create_all() only creates missing tables, so changes to existing tables (new indexes, constraints,
+# columns) are applied here. Migrations run in order, once per database, and are recorded in the
+# schema_migration table. A fresh database already gets the full schema from create_all(), so every
+# migration must also be a harmless no-op there. Add new migrations to the end of MIGRATIONS.
+
+
+# Tag names become unique. Older versions of create_club could add the same tag name twice,
+# so duplicates are merged into the oldest tag before the unique index is built.
+def merge_duplicate_tags():
+    duplicates = db.session.execute(
+        select(Tag.name, func.min(Tag.id)).group_by(Tag.name).having(func.count() > 1)
+    ).all()
+    for name, keep_id in duplicates:
+        duplicate_ids = select(Tag.id).where(Tag.name == name, Tag.id != keep_id)
+        db.session.execute(
+            insert_or_ignore(clubs_to_tags).from_select(
+                ["club_id", "tag_id"],
+                select(clubs_to_tags.c.club_id, literal(keep_id)).where(clubs_to_tags.c.tag_id.in_(duplicate_ids)),
+            )
+        )
+        db.session.execute(delete(clubs_to_tags).where(clubs_to_tags.c.tag_id.in_(duplicate_ids)))
+        db.session.execute(delete(Tag).where(Tag.id.in_(duplicate_ids)))
+
+
+# Creates the named indexes declared in models.py that don't exist yet. Every migration lists the
+# indexes it adds, so upgrading an old database never builds an index on a column that only a later
+# migration adds.
+def create_indexes(*names):
+    if "index_club_code" in names:
+        duplicate_codes = db.session.execute(
+            select(Club.code).group_by(Club.code).having(func.count() > 1)
+        ).scalars().all()
+        if duplicate_codes:
+            raise RuntimeError(f"Can't add a unique index on club codes, duplicated codes: {', '.join(duplicate_codes)}")
+
+    indexes = {index.name: index for table in db.metadata.sorted_tables for index in table.indexes}
+    connection = db.session.connection()
+    for name in names:
+        indexes[name].create(connection, checkfirst=True)
+
+
+# Adds Club.revision (see models.next_club_revision) and its index. Existing clubs start at revision 0,
+# below any version, and are picked up by the full build club_fragments.py starts with.
+def add_club_revision():
+    columns = {column["name"] for column in inspect(db.session.connection()).get_columns("club")}
+    if "revision" not in columns:
+        db.session.execute(text("ALTER TABLE club ADD COLUMN revision INTEGER NOT NULL DEFAULT 0"))
+    create_indexes("index_club_revision")
+
+
+# Adds the time favorites were made (user_to_favorite_club.created_at) and builds the trending rollups
+# (see trending.py) from recent comments. Existing favorites have no time and don't count as trending.
+def add_trending():
+    columns = {column["name"] for column in inspect(db.session.connection()).get_columns("user_to_favorite_club")}
+    if "created_at" not in columns:
+        db.session.execute(text("ALTER TABLE user_to_favorite_club ADD COLUMN created_at DATETIME"))
+    rebuild_trending()
+
+
+MIGRATIONS = [
+    (1, "merge_duplicate_tags", merge_duplicate_tags),
+    (2, "create_indexes", partial(
+        create_indexes, "index_club_code", "index_tag_name", "index_comments_club_id_parent_comment_id",
+        "index_comments_user_id", "index_comments_parent_comment_id", "index_clubs_to_tags",
+        "index_clubs_to_tags_tag_id", "index_users_to_club", "index_user_to_favorite_club_club_id",
+    )),
+    (3, "build_tag_stats", rebuild_tag_stats),
+    (4, "create_club_favorites_index", partial(create_indexes, "index_club_favorites")),
+    (5, "add_club_revision", add_club_revision),
+    (6, "add_trending", add_trending),
+]
+
+
+# Creates missing tables and applies every pending migration, each in its own transaction.
+# Returns the names of the migrations that were applied.
+def migrate():
+    db.create_all()
+    applied = set(db.session.execute(select(schema_migration.c.version)).scalars())
+    ran = []
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            migration()
+            db.session.execute(insert(schema_migration).values(version=version, name=name))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        ran.append(name)
+    return ran
@@ -1,21 +1,87 @@
 from db import db
 from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import hasher
 
 
 # Defines the association table for a many-to-many relationship between clubs and tags
 clubs_to_tags = db.Table('clubs_to_tags',
                          db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
                          db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
-                         db.Index('index_clubs_to_tags', 'club_id', 'tag_id')
+                         db.Index('index_clubs_to_tags', 'club_id', 'tag_id'),
+                         db.Index('index_clubs_to_tags_tag_id', 'tag_id')
                          )
 
 # Defines the association table for a many-to-many relationship between users and clubs they've favorited
 user_to_favorite_club = db.Table('user_to_favorite_club',
                                  db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
                                  db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
-                                 db.Index('index_users_to_club', 'user_id', 'club_id')
+                                 db.Column('created_at', db.DateTime, server_default=db.func.now()),
+                                 db.Index('index_users_to_club', 'user_id', 'club_id'),
+                                 db.Index('index_user_to_favorite_club_club_id', 'club_id')
                                  )
 
+# Version counter per table, bumped in the same transaction as every write to that table.
+# Read endpoints derive their ETags from these counters, see versions.py.
+table_version = db.Table('table_version',
+                         db.Column('name', db.String(80), primary_key=True),
+                         db.Column('version', db.Integer, nullable=False)
+                         )
+
+# Club rows are changed by club writes, which bump "club", and by favorites, which bump "favorites".
+# A club's version is the sum of both counters.
+CLUB_VERSIONS = ("club", "favorites")
+
+# The revision a club row gets on every insert and update: the club version that the write's own
+# bump("club") or bump("favorites") moves it to. Clubs changed since a version a reader has seen are the
+# ones with a higher revision, which is how club_fragments.py finds the clubs it has to re-encode.
+def next_club_revision():
+    # Not IN, which can't be used in the executemany inserts of bulk loads.
+    names = db.or_(*(table_version.c.name == name for name in CLUB_VERSIONS))
+    current = db.select(db.func.sum(table_version.c.version)).where(names).scalar_subquery()
+    return db.func.coalesce(current, 0) + 1
+
+# Number of clubs per tag, kept up to date by every write that changes club tags (see tag_stats.py)
+# so /api/tags doesn't have to aggregate clubs_to_tags on every request.
+tag_stats = db.Table('tag_stats',
+                     db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+                     db.Column('num_clubs', db.Integer, nullable=False, default=0)
+                     )
+
+# Favorites and comments per club in hourly buckets (bucket = hours since the epoch), recorded by the
+# writes themselves so trending.py never has to aggregate comments or favorites per request.
+club_activity = db.Table('club_activity',
+                         db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+                         db.Column('bucket', db.Integer, primary_key=True),
+                         db.Column('favorites', db.Integer, nullable=False, default=0),
+                         db.Column('comments', db.Integer, nullable=False, default=0),
+                         db.Index('index_club_activity_bucket', 'bucket')
+                         )
+
+# Running activity totals per club over each trending window (see trending.WINDOWS), covering the
+# club_activity buckets from the window's start in trending_window onwards.
+trending_score = db.Table('trending_score',
+                          db.Column('window_name', db.String(16), primary_key=True),
+                          db.Column('club_id', db.Integer, db.ForeignKey('club.id'), primary_key=True),
+                          db.Column('favorites', db.Integer, nullable=False, default=0),
+                          db.Column('comments', db.Integer, nullable=False, default=0),
+                          db.Column('score', db.Integer, nullable=False, default=0)
+                          )
+# Highest scores first, for GET /api/clubs/trending.
+db.Index('index_trending_score', trending_score.c.window_name, trending_score.c.score.desc(), trending_score.c.club_id)
+
+# First bucket counted in each trending window's totals, moved forward by compaction.
+trending_window = db.Table('trending_window',
+                           db.Column('window_name', db.String(16), primary_key=True),
+                           db.Column('start', db.Integer, nullable=False)
+                           )
+
+# Records which schema migrations from migrations.py have been applied to this database.
+schema_migration = db.Table('schema_migration',
+                            db.Column('version', db.Integer, primary_key=True),
+                            db.Column('name', db.String(80), nullable=False),
+                            db.Column('applied_at', db.DateTime, server_default=db.func.now())
+                            )
+
 
 # Each model has a column for a unique id, which makes searching and comparing inside a model more efficient.
 # Additionally, each model has a to_dict method, which returns a dictionary representation of the model's data.
@@ -24,31 +90,42 @@ user_to_favorite_club = db.Table('user_to_favorite_club',
 # Defines the Club model. Includes a table of values for the club's code, name, description, and tags.
 class Club(db.Model):
     __tablename__ = 'club'
+    __table_args__ = (db.Index('index_club_code', 'code', unique=True),)
 
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(80), nullable=False)
     name = db.Column(db.String(80), nullable=False)
     description = db.Column(db.String(1000), nullable=False)
     favorites = db.Column(db.Integer, default=0)
+    revision = db.Column(db.Integer, nullable=False, default=next_club_revision(), onupdate=next_club_revision(),
+                         server_default="0")
 
     tags = db.relationship('Tag', secondary=clubs_to_tags, back_populates='clubs')
     users = db.relationship('User', secondary=user_to_favorite_club, back_populates='fav_clubs')
     comments = db.relationship('Comment', back_populates='club')
 
-    def to_dict(self):
-        return {
-            "id": self.id, 
-            "code": self.code, 
-            "name": self.name, 
-            "description": self.description, 
-            "tags": [tag.name for tag in self.tags], 
-            "favorites": self.favorites
-        }
+    # Fields that to_dict can return. Passing a subset only touches the columns and relationships it needs.
+    FIELDS = ("id", "code", "name", "description", "tags", "favorites")
+
+    def to_dict(self, fields=None):
+        data = {}
+        for field in fields or self.FIELDS:
+            if field == "tags":
+                data["tags"] = [tag.name for tag in self.tags]
+            else:
+                data[field] = getattr(self, field)
+        return data
+
+# Most favorited clubs first, for GET /api/clubs?sort=favorites.
+db.Index('index_club_favorites', Club.favorites.desc(), Club.id)
+# Clubs changed since a given version, see next_club_revision.
+db.Index('index_club_revision', Club.revision)
 
 # Defines the Tag model. Includes a table of values for the tag's name and the clubs associated with the tag.
 
 class Tag(db.Model):
     __tablename__ = 'tag'
+    __table_args__ = (db.Index('index_tag_name', 'name', unique=True),)
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
@@ -77,7 +154,7 @@ class User(db.Model):
     comments = db.relationship('Comment', back_populates='user')
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(password, hasher.method)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
@@ -110,6 +187,11 @@ class User(db.Model):
 # comment's user, club, parent comment, text, and timestamp.
 class Comment(db.Model):
     __tablename__ = 'comments'
+    __table_args__ = (
+        db.Index('index_comments_club_id_parent_comment_id', 'club_id', 'parent_comment_id'),
+        db.Index('index_comments_user_id', 'user_id'),
+        db.Index('index_comments_parent_comment_id', 'parent_comment_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -121,12 +203,15 @@ class Comment(db.Model):
     text = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, server_default=db.func.now())
     
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "user": self.user.username,
-            "club": self.club.name,
-            "parent_comment_id": self.parent_comment_id,
-            "text": self.text,
-            "timestamp": self.timestamp
-        }
\ No newline at end of file
+    FIELDS = ("id", "user", "club", "parent_comment_id", "text", "timestamp")
+
+    def to_dict(self, fields=None):
+        data = {}
+        for field in fields or self.FIELDS:
+            if field == "user":
+                data["user"] = self.user.username
+            elif field == "club":
+                data["club"] = self.club.name
+            else:
+                data[field] = getattr(self, field)
+        return data
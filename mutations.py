@@ -0,0 +1,169 @@
+from sqlalchemy.orm import selectinload
+
+from cache import cache
+from db import db
+from models import *
+from search import index_clubs
+from tag_index import tag_index
+from tag_stats import apply_tag_deltas, tag_changes, tag_deltas
+from versions import bump, current_versions
+
+# Write-side helpers for clubs, shared by the single club endpoints and the batch endpoints in app.py.
+# Tags for any number of clubs are resolved with one IN query, and every club write ends with
+# commit_club_writes(), which keeps the tag counts, search index, table versions and response cache in sync.
+
+# Largest number of clubs accepted by one batch request.
+MAX_BATCH_SIZE = 1000
+
+REQUIRED_FIELDS = ["code", "name", "description", "tags"]
+
+
+# Returns a dict of tag name -> Tag for the given names, loading the existing ones with a single
+# IN query and adding new Tag objects to the session for the rest.
+def resolve_tags(names):
+    names = list(dict.fromkeys(names))
+    tags = {tag.name: tag for tag in db.session.query(Tag).filter(Tag.name.in_(names))} if names else {}
+    for name in names:
+        if name not in tags:
+            tags[name] = Tag(name=name)
+            db.session.add(tags[name])
+    return tags
+
+
+def new_club(data, tags):
+    club = Club(code=data["code"], name=data["name"], description=data["description"], favorites=0)
+    club.tags = [tags[name] for name in dict.fromkeys(data["tags"])]
+    db.session.add(club)
+    return club
+
+
+# Applies the modifiable fields of data to an existing club: name and description when non-empty,
+# and tags (replacing the old ones) when present.
+def update_club(club, data, tags):
+    if "name" in data and data["name"]:
+        club.name = data["name"]
+    if "description" in data and data["description"]:
+        club.description = data["description"]
+    if "tags" in data:
+        club.tags = [tags[name] for name in dict.fromkeys(data["tags"])]
+
+
+# Cache groups made stale by renaming the given clubs. Comments embed the club name, so each club's
+# comment thread and the comment lists of everyone who commented on it are affected.
+def renamed_club_groups(clubs):
+    if not clubs:
+        return []
+    commenters = (
+        db.session.query(Comment.user_id)
+        .filter(Comment.club_id.in_([club.id for club in clubs]))
+        .distinct()
+    )
+    groups = [f"club_comments:{club.code}" for club in clubs]
+    groups.extend(f"user_comments:{user_id}" for user_id, in commenters)
+    return groups
+
+
+# Flushes the written clubs, updates the tag counts, re-indexes the clubs for search, bumps the club
+# and tag versions and commits. Then updates the in-memory tag index and invalidates the tag counts and
+# the cache groups of the renamed clubs (see renamed_club_groups).
+def commit_club_writes(clubs, renamed=()):
+    # Taken first: any query autoflushes the session, which clears the tag history.
+    changes = tag_changes(clubs)
+    invalidated = renamed_club_groups(renamed)
+    # A change to only the tags doesn't update the club row, so its revision is moved explicitly.
+    for club in clubs:
+        club.revision = next_club_revision()
+    db.session.flush()
+    apply_tag_deltas({tag.id: delta for tag, delta in tag_deltas(changes).items()})
+    index_clubs(clubs)
+    tag_version = current_versions(["tag"])[0]
+    bump("club", "tag")
+    db.session.commit()
+    tag_index.apply(changes, tag_version)
+    cache.invalidate("tags", *invalidated)
+
+
+# Creates a club from data in the format of POST /api/clubs and commits. Returns False, without
+# writing anything, if the code is taken. Raises IntegrityError if another request created the code or
+# one of the new tags after they were looked up; rolling back and calling it again checks them anew.
+def write_new_club(data):
+    if db.session.query(Club).filter_by(code=data["code"]).first() is not None:
+        return False
+    commit_club_writes([new_club(data, resolve_tags(data["tags"]))])
+    return True
+
+
+# Applies data to the club with the given code like PUT /api/clubs/<code> and commits. Returns False
+# if there is no such club. Raises IntegrityError if another request created one of the new tags after
+# they were looked up; rolling back and calling it again finds them.
+def write_club_update(code, data):
+    club = db.session.query(Club).filter_by(code=code).first()
+    if club is None:
+        return False
+    renamed = [club] if data.get("name") and data["name"] != club.name else []
+    update_club(club, data, resolve_tags(data.get("tags", [])))
+    commit_club_writes([club], renamed)
+    return True
+
+
+# Returns why a batch item can't be written, or None if it can. Items for new clubs need every field
+# in REQUIRED_FIELDS; updates only the ones they change. name and description must be non-empty strings
+# for new clubs and strings for updates (empty ones are left unchanged), and tags a list of strings.
+def batch_item_error(item, exists):
+    if not exists and not all(field in item for field in REQUIRED_FIELDS):
+        return "Request must contain code, name, description, and tags"
+    for field in ("name", "description"):
+        if field in item and not (isinstance(item[field], str) and (item[field] or exists)):
+            return f"{field.capitalize()} must be a non-empty string"
+    if "tags" in item and not (isinstance(item["tags"], list) and all(isinstance(tag, str) for tag in item["tags"])):
+        return "Tags must be a list of strings"
+    return None
+
+
+# Creates (and with upsert=True, updates) many clubs in one transaction.
+# items is a list of club dicts in the format of POST /api/clubs. Existing clubs are only updated when
+# upserting, with the same rules as PUT /api/clubs/<code>. Returns one result per item, in order,
+# with the item's code, an HTTP-style status and a message; invalid items don't stop the others.
+def write_club_batch(items, upsert):
+    codes = [item.get("code") for item in items if isinstance(item, dict) and isinstance(item.get("code"), str)]
+    existing = {
+        club.code: club
+        for club in db.session.query(Club).options(selectinload(Club.tags)).filter(Club.code.in_(codes))
+    }
+
+    results = []
+    accepted = []
+    seen = set()
+    for item in items:
+        code = item.get("code") if isinstance(item, dict) else None
+        if not isinstance(code, str) or not code:
+            results.append({"code": None, "status": 400, "message": "Club must be a JSON object with a code"})
+            continue
+        error = batch_item_error(item, code in existing)
+        if code in seen:
+            results.append({"code": code, "status": 400, "message": "Duplicate club code in batch"})
+        elif code in existing and not upsert:
+            results.append({"code": code, "status": 400, "message": "Club code is taken"})
+        elif error is not None:
+            results.append({"code": code, "status": 400, "message": error})
+        else:
+            results.append({"code": code, "status": 200,
+                            "message": "Club updated" if code in existing else "Club added"})
+            accepted.append(item)
+        seen.add(code)
+
+    tags = resolve_tags(name for item in accepted for name in item.get("tags", []))
+    clubs = []
+    renamed = []
+    for item in accepted:
+        club = existing.get(item["code"])
+        if club is None:
+            clubs.append(new_club(item, tags))
+            continue
+        if item.get("name") and item["name"] != club.name:
+            renamed.append(club)
+        update_club(club, item, tags)
+        clubs.append(club)
+
+    commit_club_writes(clubs, renamed)
+    return results
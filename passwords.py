@@ -0,0 +1,114 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password hashing for /api/login. Hashes are deliberately slow to compute, so they run in a small
+# process pool instead of on the request thread, which leaves the other endpoints responsive while
+# logins are being checked. At most max_pending hashes are queued or running at once; past that
+# PasswordHasher raises HasherBusy and the login endpoint answers 503 instead of piling up work.
+# Stored hashes that were made with a different method or cost are re-hashed on the next login.
+# The pool's processes are started with forkserver (spawn where it isn't available) rather than fork,
+# since forking a process that already runs server, writer and connection pool threads can deadlock
+# the child.
+
+DEFAULT_METHOD = "scrypt:32768:8:1"
+
+# Werkzeug's defaults for the parameters a method string may leave out.
+METHOD_DEFAULTS = {"scrypt": ["32768", "8", "1"], "pbkdf2": ["sha256", "600000"]}
+
+
+class HasherBusy(Exception):
+    pass
+
+
+# Expands a werkzeug method string to the form stored in hashes, e.g. "scrypt" -> "scrypt:32768:8:1".
+def full_method(method):
+    name, *params = method.split(":")
+    defaults = METHOD_DEFAULTS.get(name, [])
+    return ":".join([name, *params, *defaults[len(params):]])
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.method = DEFAULT_METHOD
+        self.workers = 2
+        self.max_pending = 8
+        self.timeout = 10
+        self.pool = None
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.rejected = 0
+
+    # Reads the hashing settings from the app config:
+    # PASSWORD_HASH_METHOD is a werkzeug method string that sets the algorithm and its cost,
+    # e.g. "scrypt:32768:8:1" (default) or "pbkdf2:sha256:600000",
+    # PASSWORD_WORKERS is the number of hashing processes (0 hashes on the request thread),
+    # PASSWORD_MAX_PENDING bounds the hashes queued or running at once and
+    # PASSWORD_TIMEOUT is how many seconds a login waits for its hash before giving up.
+    def init_app(self, app):
+        self.method = full_method(app.config.get("PASSWORD_HASH_METHOD", DEFAULT_METHOD))
+        self.workers = app.config.get("PASSWORD_WORKERS", 2)
+        self.max_pending = app.config.get("PASSWORD_MAX_PENDING", 4 * max(self.workers, 1))
+        self.timeout = app.config.get("PASSWORD_TIMEOUT", 10)
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+                self.pool = None
+            if self.workers:
+                self.start_pool()
+
+    # Creates the worker pool. Call with the lock held.
+    def start_pool(self):
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context(method))
+
+    # Runs fn(*args) in the pool and waits for its result. Raises HasherBusy if too many hashes are
+    # pending, or if this one doesn't finish within the timeout.
+    def run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy()
+        try:
+            with self.lock:
+                # Only after a worker died, see reset_if_broken.
+                if self.pool is None:
+                    self.start_pool()
+                future = self.pool.submit(fn, *args)
+        except BaseException as e:
+            self.slots.release()
+            self.reset_if_broken(e)
+            raise
+        # The slot is held until the hash is done, even if this request stops waiting for it.
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HasherBusy()
+        except BrokenProcessPool as e:
+            self.reset_if_broken(e)
+            raise
+
+    # A worker process died, which breaks the whole pool. Drop it so the next hash starts a fresh one.
+    def reset_if_broken(self, error):
+        if isinstance(error, BrokenProcessPool):
+            with self.lock:
+                self.pool = None
+
+    def check(self, password_hash, password):
+        return self.run(check_password_hash, password_hash, password)
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    # True if the hash was made with a different method or cost than the configured one.
+    def needs_rehash(self, password_hash):
+        return password_hash.split("$", 1)[0] != self.method
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,348 @@
+from contextlib import contextmanager
+
+from flask import current_app, jsonify, request, stream_with_context
+from sqlalchemy import event, func, literal, select
+from sqlalchemy.orm import joinedload, load_only, selectinload
+
+from db import db
+from models import Club, Comment, User, user_to_favorite_club
+
+# Shared read-side query layer. Every read endpoint builds its query from one of these helpers
+# so that relationships used by to_dict() are loaded up front instead of lazily per row.
+# Clubs load their tags with a single extra SELECT ... WHERE club_id IN (...), and comments
+# join their user and club, so each response costs a constant number of queries.
+# When a fields= projection is given, only the columns and relationships it needs are loaded.
+
+# Upper bound for the limit= query parameter on paginated list endpoints.
+MAX_PAGE_SIZE = 500
+
+# Rows fetched from the database cursor, and items encoded and sent, at a time by streamed list responses.
+STREAM_BATCH_SIZE = 500
+
+# Media type of newline delimited JSON, one item per line, which list endpoints send when it is asked
+# for with the Accept header.
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+
+def clubs_query(fields=None):
+    fields = fields or Club.FIELDS
+    columns = [getattr(Club, field) for field in fields if field in ("code", "name", "description", "favorites")]
+    query = db.session.query(Club).options(load_only(Club.id, *columns))
+    if "tags" in fields:
+        query = query.options(selectinload(Club.tags))
+    return query.order_by(Club.id)
+
+
+# Yields the clubs with the given ids, in the order of ids, loading MAX_PAGE_SIZE at a time. For pages
+# whose members and order were worked out elsewhere, e.g. by the tag index in tag_index.py.
+def clubs_by_id(ids, fields=None):
+    for start in range(0, len(ids), MAX_PAGE_SIZE):
+        chunk = ids[start:start + MAX_PAGE_SIZE]
+        clubs = {club.id: club for club in clubs_query(fields).filter(Club.id.in_(chunk))}
+        yield from (clubs[club_id] for club_id in chunk if club_id in clubs)
+
+
+def comments_query(fields=None):
+    fields = fields or Comment.FIELDS
+    query = db.session.query(Comment)
+    if "user" in fields:
+        query = query.options(joinedload(Comment.user))
+    if "club" in fields:
+        query = query.options(joinedload(Comment.club))
+    return query.order_by(Comment.id)
+
+
+def club_comments(club, fields=None, limit=None, after=None):
+    query = comments_query(fields).filter(Comment.club_id == club.id)
+    return paginate(query, Comment.id, limit, after)
+
+
+def user_comments(user, fields=None, limit=None, after=None):
+    query = comments_query(fields).filter(Comment.user_id == user.id)
+    return paginate(query, Comment.id, limit, after)
+
+
+# Number of recent comments in a user profile by default, and the most that can be asked for.
+DEFAULT_PROFILE_COMMENTS = 10
+MAX_PROFILE_COMMENTS = 50
+
+# Largest number of users in one batch profile request.
+MAX_PROFILE_BATCH = 100
+
+
+# Loads the profiles of the given users: the public user, their favorite clubs (with tags, ordered by
+# id) and their n_comments most recent comments, newest first. Returns {user id: profile dict} for the
+# users that exist. Takes four queries however many users there are: the users, their favorites, the
+# favorite clubs' tags and the recent comments, which are picked per user with a ROW_NUMBER() window.
+def user_profiles(user_ids, n_comments=DEFAULT_PROFILE_COMMENTS):
+    users = db.session.query(User).filter(User.id.in_(user_ids)).all()
+    profiles = {user.id: {**user.to_public_dict(), "favorites": [], "recent_comments": []} for user in users}
+    if not profiles:
+        return profiles
+
+    favorites = (
+        db.session.query(user_to_favorite_club.c.user_id, Club)
+        .join(Club, Club.id == user_to_favorite_club.c.club_id)
+        .filter(user_to_favorite_club.c.user_id.in_(profiles))
+        .options(selectinload(Club.tags))
+        .order_by(user_to_favorite_club.c.user_id, Club.id)
+    )
+    for user_id, club in favorites:
+        profiles[user_id]["favorites"].append(club.to_dict())
+
+    if n_comments:
+        ranked = (
+            select(Comment.id, func.row_number().over(partition_by=Comment.user_id, order_by=Comment.id.desc())
+                   .label("rank"))
+            .where(Comment.user_id.in_(profiles))
+            .subquery()
+        )
+        comments = (
+            comments_query()
+            .join(ranked, ranked.c.id == Comment.id)
+            .filter(ranked.c.rank <= n_comments)
+            .order_by(None)
+            .order_by(Comment.user_id, Comment.id.desc())
+        )
+        for comment in comments:
+            profiles[comment.user_id]["recent_comments"].append(comment.to_dict())
+    return profiles
+
+
+# Parses the comments= parameter of the profile endpoints, the number of recent comments to return.
+# Raises ValueError with a user-facing message if it is malformed.
+def parse_profile_comments(args):
+    try:
+        n_comments = int(args.get("comments", DEFAULT_PROFILE_COMMENTS))
+    except ValueError:
+        raise ValueError("comments must be an integer")
+    if not 0 <= n_comments <= MAX_PROFILE_COMMENTS:
+        raise ValueError(f"comments must be between 0 and {MAX_PROFILE_COMMENTS}")
+    return n_comments
+
+
+# Parses the ids= parameter of the batch profile endpoint, a comma separated list of user ids.
+# Raises ValueError with a user-facing message if it is missing, malformed or too long.
+def parse_user_ids(args):
+    try:
+        user_ids = [int(user_id) for user_id in args.get("ids", "").split(",") if user_id.strip()]
+    except ValueError:
+        raise ValueError("ids must be a comma separated list of user ids")
+    if not 1 <= len(user_ids) <= MAX_PROFILE_BATCH:
+        raise ValueError(f"ids must list between 1 and {MAX_PROFILE_BATCH} user ids")
+    return list(dict.fromkeys(user_ids))
+
+
+# Largest max_depth accepted by the comment tree endpoints.
+MAX_TREE_DEPTH = 20
+
+# Top-level comments per page of the comment tree endpoint when no limit is given.
+DEFAULT_TREE_PAGE_SIZE = 50
+
+# Most comments in one tree response, roots included, so a busy thread can't make it unbounded.
+MAX_TREE_NODES = 1000
+
+
+# Loads comment threads of a club as nested dicts with a single recursive CTE query.
+# The threads start at root_id, or at the club's top-level comments (at most limit of them, with ids
+# above after) when root_id is None. Replies are followed at most max_depth levels below the roots.
+# At most MAX_TREE_NODES comments are loaded, level by level, so the deepest replies are the ones left
+# out of a large tree.
+# Every node has the fields of Comment.to_dict, a reply_count of its direct replies (including ones cut
+# off by max_depth or MAX_TREE_NODES) and the loaded replies. Returns the roots and the cursor for the
+# next page of top-level comments, which is None on the last page.
+def comment_tree(club, root_id=None, max_depth=MAX_TREE_DEPTH, limit=None, after=None):
+    roots = select(Comment.id).where(Comment.club_id == club.id)
+    if root_id is not None:
+        roots = roots.where(Comment.id == root_id)
+    else:
+        roots = roots.where(Comment.parent_comment_id.is_(None)).order_by(Comment.id)
+        if after is not None:
+            roots = roots.where(Comment.id > after)
+        if limit is not None:
+            roots = roots.limit(limit)
+    roots = roots.subquery()
+
+    tree = select(roots.c.id, literal(0).label("depth")).cte("tree", recursive=True)
+    tree = tree.union_all(
+        select(Comment.id, tree.c.depth + 1)
+        .join(tree, Comment.parent_comment_id == tree.c.id)
+        .where(tree.c.depth < max_depth)
+    )
+    reply_counts = (
+        select(Comment.parent_comment_id, func.count().label("reply_count"))
+        .where(Comment.parent_comment_id.in_(select(tree.c.id)))
+        .group_by(Comment.parent_comment_id)
+        .subquery()
+    )
+    rows = (
+        db.session.query(Comment, tree.c.depth, func.coalesce(reply_counts.c.reply_count, 0))
+        .join(tree, tree.c.id == Comment.id)
+        .outerjoin(reply_counts, reply_counts.c.parent_comment_id == Comment.id)
+        .options(joinedload(Comment.user))
+        .order_by(tree.c.depth, Comment.id)
+        .limit(MAX_TREE_NODES)
+        .all()
+    )
+
+    # Rows come parents first, so every reply's parent node already exists when it is attached.
+    nodes = {}
+    top_level = []
+    for comment, depth, reply_count in rows:
+        node = comment.to_dict()
+        node["reply_count"] = reply_count
+        node["replies"] = []
+        nodes[comment.id] = node
+        if depth == 0:
+            top_level.append(node)
+        else:
+            nodes[comment.parent_comment_id]["replies"].append(node)
+
+    next_cursor = top_level[-1]["id"] if root_id is None and limit is not None and len(top_level) == limit else None
+    return top_level, next_cursor
+
+
+# Parses the opt-in keyset pagination parameters, limit= and after=, from the query string.
+# Both are optional. Raises ValueError with a user-facing message if either is malformed.
+def parse_page_args(args):
+    limit = args.get("limit")
+    after = args.get("after")
+    try:
+        limit = int(limit) if limit is not None else None
+        after = int(after) if after is not None else None
+    except ValueError:
+        raise ValueError("limit and after must be integers")
+    if limit is not None and not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    return limit, after
+
+
+# Parses the fields= projection, a comma separated list of keys to return for each item.
+# Returns None when no projection was asked for. Raises ValueError on unknown fields.
+def parse_fields(args, allowed):
+    fields = args.get("fields")
+    if fields is None:
+        return None
+    fields = tuple(field.strip() for field in fields.split(",") if field.strip())
+    unknown = [field for field in fields if field not in allowed]
+    if not fields or unknown:
+        raise ValueError(f"fields must be a comma separated list of: {', '.join(allowed)}")
+    return fields
+
+
+# Parses the club list filters: tags= (comma separated tag names), match= ("all", the default, or "any")
+# and sort= ("id", the default, or "favorites"). Returns (tag names, match, sort).
+# Raises ValueError with a user-facing message if match or sort is unknown.
+def parse_club_filters(args):
+    tags = [tag.strip() for tag in args.get("tags", "").split(",") if tag.strip()]
+    match = args.get("match", "all")
+    sort = args.get("sort", "id")
+    if match not in ("all", "any"):
+        raise ValueError("match must be all or any")
+    if sort not in ("id", "favorites"):
+        raise ValueError("sort must be id or favorites")
+    return tags, match, sort
+
+
+# Applies keyset pagination on an id column: rows with id > after, at most limit of them.
+# Returns the rows and the cursor for the next page, which is None on the last page.
+# Without a limit every matching row is returned, as the endpoints did before pagination. Those rows
+# come as a query that fetches them from the database cursor STREAM_BATCH_SIZE at a time while it is
+# iterated, so they can be sent with stream_response() without holding all of them in memory.
+def paginate(query, id_column, limit=None, after=None):
+    if after is not None:
+        query = query.filter(id_column > after)
+    if limit is None:
+        return query.yield_per(STREAM_BATCH_SIZE), None
+    rows = query.limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+# Builds the JSON list response for a page of items. The cursor for the next page is sent in the
+# X-Next-Cursor header so the body stays a plain list for existing callers.
+def page_response(items, next_cursor=None):
+    response = jsonify(items)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return response, 200
+
+
+# True if the client asked for NDJSON rather than a JSON list in its Accept header.
+def wants_ndjson():
+    return request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+
+# Like page_response(), but encodes and sends the list while rows are still being read, so neither the
+# list of dicts nor the JSON string of a long list is built in memory and the first bytes go out right
+# away. rows is any iterable, e.g. the query returned by paginate(), and to_dict turns a row into its
+# item. The body is the same JSON list as jsonify() would send, or one item per line when the client
+# accepts NDJSON_MIMETYPE.
+def stream_response(rows, to_dict, next_cursor=None):
+    dumps = current_app.json.dumps
+    return stream_encoded((dumps(to_dict(row), separators=(",", ":")).encode() for row in rows), next_cursor)
+
+
+# Streams items that are already encoded as JSON bytes, STREAM_BATCH_SIZE at a time, as a JSON list
+# or as NDJSON. See stream_response().
+def stream_encoded(items, next_cursor=None):
+    ndjson = wants_ndjson()
+
+    def generate():
+        batch = []
+        first = True
+        for item in items:
+            batch.append(item)
+            if len(batch) == STREAM_BATCH_SIZE:
+                yield encode_batch(batch, ndjson, first)
+                batch = []
+                first = False
+        if batch or first:
+            yield encode_batch(batch, ndjson, first)
+        if not ndjson:
+            yield b"]\n"
+
+    response = current_app.response_class(stream_with_context(generate()),
+                                          mimetype=NDJSON_MIMETYPE if ndjson else "application/json")
+    response.vary.add("Accept")
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return response, 200
+
+
+# Encodes one batch of JSON items for stream_encoded(). The first batch of a list opens the list.
+def encode_batch(items, ndjson, first):
+    if ndjson:
+        return b"".join(item + b"\n" for item in items)
+    return (b"[" if first else b",") + b",".join(items)
+
+
+# Records every SQL statement sent to the database while the block runs.
+# Yields the list of statements, which is filled in as queries execute, as (statement, parameters)
+# pairs with with_parameters=True.
+@contextmanager
+def count_queries(with_parameters=False):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters) if with_parameters else statement)
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+# Test helper that fails if the block issues more than the expected number of SQL statements.
+# Example:
+#     with app.test_client() as client, assert_max_queries(2):
+#         client.get("/api/clubs")
+@contextmanager
+def assert_max_queries(expected):
+    with count_queries() as statements:
+        yield statements
+    if len(statements) > expected:
+        formatted = "\n".join(statements)
+        raise AssertionError(f"Expected at most {expected} queries, got {len(statements)}:\n{formatted}")
@@ -0,0 +1,122 @@
+from sqlalchemy import select
+
+from db import db
+from models import *
+from queries import assert_max_queries, count_queries
+
+# Query plan checks for the read endpoints. Every SELECT an endpoint sends is run through
+# EXPLAIN QUERY PLAN, and any full table scan ("SCAN <table>" without an index) of a real table
+# is reported, except for the scans an endpoint needs by design, like listing every club.
+# Each endpoint is also held to a budget of SQL statements per request, so a query per row (N+1)
+# shows up as a failure.
+# Run with `python manage.py check-plans`; it exits with an error if anything falls back to a scan
+# or goes over its budget.
+
+# Tables each endpoint is expected to read in full.
+ALLOWED_SCANS = {
+    "/api/clubs": {"club"},
+    "/api/tags": {"tag"},
+    "/api/clubs/trending": {"trending_window"},
+}
+
+# Most SQL statements one request to each endpoint (by URL rule) may send, whatever is in the database.
+# Counted on a second request to the URL, so one-off work like building the club fragments isn't included.
+QUERY_BUDGETS = {
+    "/api/clubs": 5,
+    "/api/clubs/trending": 5,
+    "/api/clubs/<string:name>": 3,
+    "/api/users/<int:user_id>": 2,
+    "/api/users/<int:user_id>/profile": 5,
+    "/api/users/profiles": 5,
+    "/api/tags": 2,
+    "/api/clubs/<string:code>/comments": 3,
+    "/api/clubs/<string:code>/comments/tree": 3,
+    "/api/clubs/<string:code>/comments/<int:comment_id>/tree": 3,
+    "/api/users/<int:user_id>/comments": 3,
+}
+
+
+# Returns the names of the tables that the statement reads with a full scan.
+def full_scans(statement, parameters):
+    tables = set(db.metadata.tables)
+    scans = set()
+    connection = db.session.connection()
+    for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters):
+        detail = row[-1]
+        if not detail.startswith("SCAN ") or " USING " in detail:
+            continue
+        table = detail.split()[1]
+        if table in tables:
+            scans.add(table)
+    return scans
+
+
+# Endpoint URLs to check, filled in with a club, user and comment from the database.
+def endpoint_urls():
+    code = db.session.execute(select(Club.code).limit(1)).scalar() or "code"
+    user_id = db.session.execute(select(User.id).limit(1)).scalar() or 1
+    comment_id = db.session.execute(select(Comment.id).limit(1)).scalar() or 1
+    return [
+        "/api/clubs",
+        "/api/clubs?limit=20&after=1",
+        "/api/clubs?fields=id,name",
+        "/api/clubs?sort=favorites&limit=20",
+        "/api/clubs?sort=favorites&limit=20&after=1",
+        "/api/clubs/trending",
+        "/api/clubs/trending?window=7d&limit=50",
+        f"/api/clubs/{code}",
+        f"/api/users/{user_id}",
+        f"/api/users/{user_id}/profile",
+        f"/api/users/profiles?ids={user_id},{user_id + 1}",
+        "/api/tags",
+        f"/api/clubs/{code}/comments",
+        f"/api/clubs/{code}/comments?limit=20&after=1",
+        f"/api/clubs/{code}/comments/tree?limit=20",
+        f"/api/clubs/{code}/comments/{comment_id}/tree",
+        f"/api/users/{user_id}/comments",
+    ]
+
+
+# Requests every endpoint URL with the response cache off and returns {url: {table, ...}} for the
+# ones whose queries fall back to full scans of tables not in ALLOWED_SCANS.
+def check_query_plans(app):
+    cache_enabled = app.config.get("CACHE_ENABLED", True)
+    app.config["CACHE_ENABLED"] = False
+    problems = {}
+    try:
+        client = app.test_client()
+        for url in endpoint_urls():
+            with count_queries(with_parameters=True) as statements:
+                client.get(url)
+            allowed = ALLOWED_SCANS.get(url.split("?")[0], set())
+            scans = set()
+            for statement, parameters in statements:
+                if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+                    scans |= full_scans(statement, parameters)
+            if scans - allowed:
+                problems[url] = scans - allowed
+    finally:
+        app.config["CACHE_ENABLED"] = cache_enabled
+    return problems
+
+
+# Requests every endpoint URL twice with the response cache off and returns {url: message} for the
+# ones whose second request sends more SQL statements than their QUERY_BUDGETS entry allows.
+def check_query_counts(app):
+    cache_enabled = app.config.get("CACHE_ENABLED", True)
+    app.config["CACHE_ENABLED"] = False
+    adapter = app.url_map.bind("localhost")
+    problems = {}
+    try:
+        client = app.test_client()
+        for url in endpoint_urls():
+            rule, _ = adapter.match(url.split("?")[0], method="GET", return_rule=True)
+            client.get(url)
+            try:
+                with assert_max_queries(QUERY_BUDGETS[rule.rule]):
+                    client.get(url)
+            except AssertionError as e:
+                problems[url] = str(e)
+    finally:
+        app.config["CACHE_ENABLED"] = cache_enabled
+    return problems
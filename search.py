@@ -0,0 +1,112 @@
+import re
+
+from sqlalchemy import Float, Integer, func, text
+
+from db import db
+from models import Club
+from queries import clubs_query
+
+# Full-text search over clubs, backed by an SQLite FTS5 table.
+# club_search holds one row per club, keyed by rowid = club.id, with the club's name, description and
+# space separated tag names. Queries match every word of the search term as a prefix and rank results
+# with bm25, weighting name matches above tag matches above description matches.
+# The table is kept in sync by calling index_clubs() whenever a club or its tags are written.
+# On databases without FTS5 (or for terms with no searchable words) search falls back to the old LIKE scan.
+
+SEARCH_TABLE = "club_search"
+
+# bm25 column weights for (name, description, tags).
+RANK_WEIGHTS = (10.0, 1.0, 5.0)
+
+
+def fts_enabled():
+    return db.engine.dialect.name == "sqlite"
+
+
+# Creates the FTS table if it doesn't exist yet and fills it from the club table.
+# Safe to call on every startup.
+def create_search_index():
+    if not fts_enabled():
+        return
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": SEARCH_TABLE}
+    ).first()
+    if exists is None:
+        db.session.execute(text(
+            f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(name, description, tags, tokenize = 'unicode61')"
+        ))
+        # Makes ORDER BY rank use the weighted bm25, which lets FTS5 compute the top results of a
+        # LIMIT query without ranking every match.
+        weights = ", ".join(str(weight) for weight in RANK_WEIGHTS)
+        db.session.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, rank) VALUES ('rank', 'bm25({weights})')"))
+        rebuild_search_index()
+    db.session.commit()
+
+
+# Re-indexes every club with a single INSERT ... SELECT, or only the clubs with an id above after_id,
+# which is how bulk loads index the clubs they appended. Does not commit, so it runs inside the
+# caller's transaction.
+def rebuild_search_index(after_id=0):
+    if not fts_enabled():
+        return
+    db.session.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid > :after_id"), {"after_id": after_id})
+    db.session.execute(text(f"""
+        INSERT INTO {SEARCH_TABLE} (rowid, name, description, tags)
+        SELECT club.id, club.name, club.description, coalesce(group_concat(tag.name, ' '), '')
+        FROM club
+        LEFT JOIN clubs_to_tags ON clubs_to_tags.club_id = club.id
+        LEFT JOIN tag ON tag.id = clubs_to_tags.tag_id
+        WHERE club.id > :after_id
+        GROUP BY club.id
+    """), {"after_id": after_id})
+
+
+# Replaces the index entries for the given clubs. The clubs must already be flushed so they have ids.
+# Does not commit, so the index changes in the same transaction as the clubs themselves.
+def index_clubs(clubs):
+    if not fts_enabled() or not clubs:
+        return
+    db.session.execute(
+        text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = :id"), [{"id": club.id} for club in clubs]
+    )
+    db.session.execute(
+        text(f"INSERT INTO {SEARCH_TABLE} (rowid, name, description, tags) VALUES (:id, :name, :description, :tags)"),
+        [{"id": club.id, "name": club.name, "description": club.description,
+          "tags": " ".join(tag.name for tag in club.tags)} for club in clubs],
+    )
+
+
+# Turns a user search term into an FTS5 query where every word must match as a prefix.
+# Words are quoted so FTS operators in the input (AND, NEAR, *, ...) are treated as plain text.
+# Returns None if the term contains no searchable words.
+def match_expression(term):
+    words = re.findall(r"\w+", term.lower())
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+
+# The previous search path: a case insensitive substring match on the club name.
+def like_search_query(term, fields=None):
+    return clubs_query(fields).filter(func.lower(Club.name).like(f"%{term.lower()}%"))
+
+
+# Returns a query for the clubs matching the search term, best matches first.
+# With a limit only the top matches are ranked and loaded.
+def search_query(term, fields=None, limit=None):
+    expression = match_expression(term)
+    if expression is None or not fts_enabled():
+        query = like_search_query(term, fields)
+        return query.limit(limit) if limit is not None else query
+
+    sql = f"SELECT rowid AS club_id, rank FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :expression ORDER BY rank"
+    if limit is not None:
+        sql += f" LIMIT {int(limit)}"
+    matches = text(sql).bindparams(expression=expression).columns(club_id=Integer, rank=Float).subquery()
+
+    return (
+        clubs_query(fields)
+        .join(matches, matches.c.club_id == Club.id)
+        .order_by(None)
+        .order_by(matches.c.rank, Club.id)
+    )
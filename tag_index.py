@@ -0,0 +1,134 @@
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import and_, or_, select
+
+from db import db
+from models import *
+from versions import current_versions
+
+# In-memory tag -> club id bitsets for filtering clubs by tag (GET /api/clubs?tags=...).
+# Each tag's clubs are stored as a Python int with bit n set for club id n, so "all of these tags" is
+# a bitwise AND and "any of these tags" a bitwise OR of a few ints, instead of a multi-way join over
+# clubs_to_tags. The index is built from clubs_to_tags and stamped with the "tag" version counter
+# (see versions.py), which every write that changes club tags bumps. Writes made through
+# commit_club_writes() in this process update the index in place; anything else, like another worker
+# process or the bulk loader, leaves the version ahead of the index, and the next lookup rebuilds it.
+
+# Largest number of matching clubs fetched with an IN list when sorting by favorites.
+# Bigger matches walk the (favorites, id) index instead and keep the ids that are in the match.
+MAX_IN_IDS = 1000
+
+# Builds a bitset from an iterable of club ids.
+def to_bitset(ids):
+    ids = list(ids)
+    if not ids:
+        return 0
+    buffer = bytearray(max(ids) // 8 + 1)
+    for club_id in ids:
+        buffer[club_id >> 3] |= 1 << (club_id & 7)
+    return int.from_bytes(buffer, "little")
+
+
+# Returns the club ids in a bitset, in ascending order. The binary string is reversed so that
+# character n is bit n, and the regex engine finds the set bits faster than a Python loop over bytes.
+def from_bitset(bits):
+    return [match.start() for match in re.finditer("1", bin(bits)[:1:-1])]
+
+
+class TagIndex:
+    def __init__(self):
+        self.bits = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    # Rebuilds the whole index from clubs_to_tags.
+    def rebuild(self):
+        version = current_versions(["tag"])[0]
+        ids_by_tag = defaultdict(list)
+        rows = db.session.execute(
+            select(Tag.name, clubs_to_tags.c.club_id).join(clubs_to_tags, clubs_to_tags.c.tag_id == Tag.id)
+        )
+        for name, club_id in rows:
+            ids_by_tag[name].append(club_id)
+        bits = {name: to_bitset(ids) for name, ids in ids_by_tag.items()}
+        with self.lock:
+            self.bits = bits
+            self.version = version
+
+    # Rebuilds the index if a write it hasn't seen has changed club tags.
+    def refresh(self):
+        if self.version is None or self.version != current_versions(["tag"])[0]:
+            self.rebuild()
+
+    # Applies the tag_changes() of a club write made in the current transaction. previous_version is the
+    # "tag" version the write started from, before its own bump. If the index wasn't at that version,
+    # it has missed other writes too and is left to be rebuilt on the next lookup.
+    def apply(self, changes, previous_version):
+        with self.lock:
+            if self.version != previous_version:
+                self.version = None
+                return
+            for club, added, removed in changes:
+                bit = 1 << club.id
+                for tag in added:
+                    self.bits[tag.name] = self.bits.get(tag.name, 0) | bit
+                for tag in removed:
+                    self.bits[tag.name] = self.bits.get(tag.name, 0) & ~bit
+            self.version = previous_version + 1
+
+    # Returns the bitset of clubs with all (match="all") or any (match="any") of the given tag names.
+    def match(self, names, match="all"):
+        self.refresh()
+        bitsets = [self.bits.get(name, 0) for name in names]
+        result = bitsets[0]
+        for bits in bitsets[1:]:
+            result = result & bits if match == "all" else result | bits
+        return result
+
+
+tag_index = TagIndex()
+
+
+# Returns the ids of one page of clubs, filtered by tags and ordered by sort, and the cursor for the
+# next page (None on the last page). names are tag names (no filter when empty), match is "all" or "any",
+# sort is "id" or "favorites" (most favorited first, ties by id). after is the id of the last club of
+# the previous page, as for the other paginated endpoints.
+def filter_club_ids(names, match="all", sort="id", limit=None, after=None):
+    matches = tag_index.match(names, match) if names else None
+
+    if sort == "id":
+        if matches is not None:
+            ids = [club_id for club_id in from_bitset(matches) if after is None or club_id > after]
+        else:
+            query = select(Club.id).order_by(Club.id)
+            if after is not None:
+                query = query.where(Club.id > after)
+            ids = db.session.execute(query.limit(limit + 1) if limit else query).scalars().all()
+    else:
+        query = select(Club.id).order_by(Club.favorites.desc(), Club.id)
+        if after is not None:
+            favorites = db.session.execute(select(Club.favorites).where(Club.id == after)).scalar() or 0
+            query = query.where(or_(Club.favorites < favorites, and_(Club.favorites == favorites, Club.id > after)))
+        if matches is None:
+            ids = db.session.execute(query.limit(limit + 1) if limit else query).scalars().all()
+        else:
+            match_ids = from_bitset(matches)
+            if len(match_ids) <= MAX_IN_IDS:
+                ids = db.session.execute(query.where(Club.id.in_(match_ids))).scalars().all()
+            else:
+                # Walk clubs in favorites order and keep matching ones until the page is full.
+                match_ids = set(match_ids)
+                ids = []
+                result = db.session.execute(query.execution_options(yield_per=1000)).scalars()
+                for club_id in result:
+                    if club_id in match_ids:
+                        ids.append(club_id)
+                        if limit is not None and len(ids) > limit:
+                            break
+                result.close()
+
+    if limit is None or len(ids) <= limit:
+        return ids[:limit], None
+    return ids[:limit], ids[limit - 1]
@@ -0,0 +1,82 @@
+from collections import Counter, defaultdict
+
+from sqlalchemy import delete, func, insert, inspect, select, update
+
+from db import db, insert_or_ignore
+from models import *
+
+# Precomputed club counts per tag for GET /api/tags, stored in the tag_stats table.
+# Club writes collect the tag changes of each club from the ORM's attribute history before flushing
+# and apply them as atomic `num_clubs = num_clubs ± n` updates in the same transaction, so the counts
+# stay exact under concurrent writes. rebuild_tag_stats() recomputes the table from clubs_to_tags and
+# check_tag_stats() compares it with the live aggregate (`python manage.py check-tag-stats`).
+
+
+# Returns (club, added tags, removed tags) for each of the given clubs, from the ORM attribute history
+# of Club.tags. Must be called before the session is flushed, which clears the history.
+def tag_changes(clubs):
+    changes = []
+    for club in clubs:
+        history = inspect(club).attrs.tags.history
+        changes.append((club, list(history.added), list(history.deleted)))
+    return changes
+
+
+# Returns a Counter of Tag -> change in club count from tag_changes() output.
+def tag_deltas(changes):
+    deltas = Counter()
+    for club, added, removed in changes:
+        deltas.update(added)
+        deltas.subtract(removed)
+    return deltas
+
+
+# Adds each delta to its tag's count. deltas maps tag ids to the change in their number of clubs.
+# Tags without a tag_stats row yet get one. Does not commit.
+def apply_tag_deltas(deltas):
+    deltas = {tag_id: delta for tag_id, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    db.session.execute(insert_or_ignore(tag_stats), [{"tag_id": tag_id, "num_clubs": 0} for tag_id in deltas])
+    by_delta = defaultdict(list)
+    for tag_id, delta in deltas.items():
+        by_delta[delta].append(tag_id)
+    for delta, tag_ids in by_delta.items():
+        db.session.execute(
+            update(tag_stats).where(tag_stats.c.tag_id.in_(tag_ids)).values(num_clubs=tag_stats.c.num_clubs + delta)
+        )
+
+
+# The live aggregate that tag_stats caches: (tag id, number of clubs) for every tag.
+def live_tag_counts():
+    return (
+        select(Tag.id, func.count(clubs_to_tags.c.club_id))
+        .outerjoin(clubs_to_tags, clubs_to_tags.c.tag_id == Tag.id)
+        .group_by(Tag.id)
+    )
+
+
+# Recomputes the whole tag_stats table from clubs_to_tags. Does not commit.
+def rebuild_tag_stats():
+    db.session.execute(delete(tag_stats))
+    db.session.execute(insert(tag_stats).from_select(["tag_id", "num_clubs"], live_tag_counts()))
+
+
+# Returns (tag name, stored count, actual count) for every tag whose stored count is wrong.
+def check_tag_stats():
+    actual = dict(db.session.execute(live_tag_counts()).all())
+    stored = dict(db.session.execute(select(tag_stats.c.tag_id, tag_stats.c.num_clubs)).all())
+    names = dict(db.session.execute(select(Tag.id, Tag.name)).all())
+    return [
+        (names[tag_id], stored.get(tag_id, 0), count)
+        for tag_id, count in actual.items() if stored.get(tag_id, 0) != count
+    ]
+
+
+# (tag name, number of clubs) for every tag, ordered by tag id, read from tag_stats.
+def tag_counts():
+    return db.session.execute(
+        select(Tag.name, func.coalesce(tag_stats.c.num_clubs, 0))
+        .outerjoin(tag_stats, tag_stats.c.tag_id == Tag.id)
+        .order_by(Tag.id)
+    ).all()
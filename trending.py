@@ -0,0 +1,256 @@
+import datetime
+import time
+from collections import Counter, defaultdict
+from functools import wraps
+
+from sqlalchemy import delete, func, insert, literal, select, update
+
+from db import db, insert_or_ignore
+from models import *
+from queries import STREAM_BATCH_SIZE, clubs_by_id
+from versions import bump
+
+# Trending clubs for GET /api/clubs/trending, ranked by recent favorites and comments.
+# Favoriting, unfavoriting and posting comments record their activity in hourly buckets (club_activity)
+# in the same transaction as the write. For every window, trending_score keeps running totals per club
+# over the buckets still inside it, indexed by score, so the top clubs are read with a short index scan
+# instead of aggregating comments and favorites over the window.
+# compact_trending() moves each window forward to the current hour, subtracting the buckets that fell out
+# of it from its totals, and deletes the buckets no window covers any more. Run it periodically with
+# `python manage.py compact-trending`; trending reads also run it once the hour has changed.
+# rebuild_trending() recomputes everything from comment timestamps and favorite times.
+
+BUCKET_SECONDS = 3600
+
+# Window name -> number of hourly buckets it covers, the current (partial) hour included.
+WINDOWS = {"24h": 24, "7d": 7 * 24}
+DEFAULT_WINDOW = "24h"
+
+# Number of clubs returned when no limit is given.
+DEFAULT_TRENDING_LIMIT = 20
+
+# A new favorite counts as much as this many comments.
+FAVORITE_WEIGHT = 3
+
+# The bucket this process last compacted the windows to, so reads only check once per hour.
+compacted = {"bucket": None}
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+# The bucket of a naive UTC datetime, like the timestamps stored in the database.
+def bucket_of(timestamp):
+    return int(timestamp.replace(tzinfo=datetime.timezone.utc).timestamp()) // BUCKET_SECONDS
+
+
+def current_bucket():
+    return int(time.time()) // BUCKET_SECONDS
+
+
+# The first bucket of every window ending at the given bucket.
+def window_starts(bucket):
+    return {name: bucket - length + 1 for name, length in WINDOWS.items()}
+
+
+def stored_window_starts():
+    return dict(db.session.execute(select(trending_window.c.window_name, trending_window.c.start)).all())
+
+
+# Adds activity to the buckets and to the totals of every window that covers them. deltas maps
+# (club id, bucket) to changes in (favorites, comments), which may be negative. Changes to buckets that
+# every window has already moved past are dropped. Does not commit.
+def record_activity(deltas):
+    deltas = {key: delta for key, delta in deltas.items() if any(delta)}
+    if not deltas:
+        return
+
+    # Inserting the bucket rows opens the write transaction before the window starts are read, so a
+    # compaction can't move a window between the read and the update of its totals. Buckets no window
+    # covers are left at zero and deleted by the next compaction.
+    db.session.execute(insert_or_ignore(club_activity), [
+        {"club_id": club_id, "bucket": bucket, "favorites": 0, "comments": 0} for club_id, bucket in deltas
+    ])
+    starts = stored_window_starts()
+    buckets = {}
+    totals = defaultdict(lambda: (0, 0))
+    for (club_id, bucket), (favorites, comments) in deltas.items():
+        windows = [name for name, start in starts.items() if bucket >= start]
+        if not windows:
+            continue
+        buckets[(club_id, bucket)] = (favorites, comments)
+        for name in windows:
+            total_favorites, total_comments = totals[(name, club_id)]
+            totals[(name, club_id)] = (total_favorites + favorites, total_comments + comments)
+
+    by_delta = defaultdict(list)
+    for (club_id, bucket), delta in buckets.items():
+        by_delta[(bucket, delta)].append(club_id)
+    for (bucket, (favorites, comments)), club_ids in by_delta.items():
+        db.session.execute(
+            update(club_activity)
+            .where(club_activity.c.bucket == bucket, club_activity.c.club_id.in_(club_ids))
+            .values(favorites=club_activity.c.favorites + favorites, comments=club_activity.c.comments + comments)
+        )
+    add_to_totals(totals)
+
+
+# Adds changes to the windows' running totals. totals maps (window name, club id) to changes in
+# (favorites, comments). Clubs without a row in a window yet get one. Does not commit.
+def add_to_totals(totals):
+    totals = {key: delta for key, delta in totals.items() if any(delta)}
+    if not totals:
+        return
+    db.session.execute(insert_or_ignore(trending_score), [
+        {"window_name": name, "club_id": club_id, "favorites": 0, "comments": 0, "score": 0} for name, club_id in totals
+    ])
+    by_delta = defaultdict(list)
+    for (name, club_id), delta in totals.items():
+        by_delta[(name, delta)].append(club_id)
+    for (name, (favorites, comments)), club_ids in by_delta.items():
+        db.session.execute(
+            update(trending_score)
+            .where(trending_score.c.window_name == name, trending_score.c.club_id.in_(club_ids))
+            .values(favorites=trending_score.c.favorites + favorites, comments=trending_score.c.comments + comments,
+                    score=trending_score.c.score + favorites * FAVORITE_WEIGHT + comments)
+        )
+
+
+# Records new comments, given as (club id, timestamp) pairs. Does not commit.
+def record_comments(comments):
+    counts = Counter((club_id, bucket_of(timestamp)) for club_id, timestamp in comments)
+    record_activity({key: (0, count) for key, count in counts.items()})
+
+
+# Records a favorite added (change=1) or removed (change=-1). A removed favorite is taken out of the
+# bucket it was added in, so favoriting and unfavoriting again doesn't push a club up. Favorites from
+# before favorite times were recorded have no created_at and are not counted. Does not commit.
+def record_favorite(club_id, created_at, change):
+    if created_at is not None:
+        record_activity({(club_id, bucket_of(created_at)): (change, 0)})
+
+
+# Moves every window forward to the given bucket (the current one by default): subtracts the buckets
+# that fell out of each window from its totals, drops clubs left without activity and deletes the
+# buckets no window covers any more. Rebuilds everything if a window has never been built.
+# Returns True if anything changed. Does not commit.
+def compact_trending(bucket=None):
+    bucket = current_bucket() if bucket is None else bucket
+    starts = stored_window_starts()
+    if set(starts) != set(WINDOWS):
+        rebuild_trending(bucket)
+        return True
+
+    new_starts = window_starts(bucket)
+    moved = False
+    for name, new_start in new_starts.items():
+        start = starts[name]
+        if new_start <= start:
+            continue
+        # Moving the window claims its expired buckets: a concurrent compaction that read the same start
+        # updates no row and leaves them alone. The update also opens the write transaction, so the
+        # buckets summed below can't change before the commit.
+        claimed = db.session.execute(
+            update(trending_window)
+            .where(trending_window.c.window_name == name, trending_window.c.start == start)
+            .values(start=new_start)
+        ).rowcount
+        if claimed != 1:
+            continue
+        moved = True
+        expired = db.session.execute(
+            select(club_activity.c.club_id, func.sum(club_activity.c.favorites), func.sum(club_activity.c.comments))
+            .where(club_activity.c.bucket >= start, club_activity.c.bucket < new_start)
+            .group_by(club_activity.c.club_id)
+        ).all()
+        add_to_totals({(name, club_id): (-favorites, -comments) for club_id, favorites, comments in expired})
+    if not moved:
+        return False
+    db.session.execute(delete(trending_score).where(trending_score.c.favorites <= 0, trending_score.c.comments <= 0))
+    db.session.execute(delete(club_activity).where(club_activity.c.bucket < min(stored_window_starts().values())))
+    bump("trending")
+    return True
+
+
+# Recomputes the buckets of the longest window and every window's totals from comment timestamps and
+# favorite times, as of the given bucket (the current one by default). Does not commit.
+def rebuild_trending(bucket=None):
+    bucket = current_bucket() if bucket is None else bucket
+    starts = window_starts(bucket)
+    since = datetime.datetime.fromtimestamp(min(starts.values()) * BUCKET_SECONDS, datetime.timezone.utc)
+    since = since.replace(tzinfo=None)
+
+    activity = defaultdict(lambda: [0, 0])
+    comments = select(Comment.club_id, Comment.timestamp).where(Comment.timestamp >= since)
+    for club_id, timestamp in db.session.execute(comments.execution_options(yield_per=STREAM_BATCH_SIZE)):
+        activity[(club_id, bucket_of(timestamp))][1] += 1
+    favorites = (
+        select(user_to_favorite_club.c.club_id, user_to_favorite_club.c.created_at)
+        .where(user_to_favorite_club.c.created_at >= since)
+    )
+    for club_id, created_at in db.session.execute(favorites.execution_options(yield_per=STREAM_BATCH_SIZE)):
+        activity[(club_id, bucket_of(created_at))][0] += 1
+
+    db.session.execute(delete(trending_score))
+    db.session.execute(delete(club_activity))
+    db.session.execute(delete(trending_window))
+    if activity:
+        db.session.execute(insert(club_activity), [
+            {"club_id": club_id, "bucket": bucket, "favorites": favorites, "comments": comments}
+            for (club_id, bucket), (favorites, comments) in activity.items()
+        ])
+    db.session.execute(insert(trending_window), [{"window_name": name, "start": start} for name, start in starts.items()])
+    for name, start in starts.items():
+        favorites, comments = func.sum(club_activity.c.favorites), func.sum(club_activity.c.comments)
+        db.session.execute(insert(trending_score).from_select(
+            ["window_name", "club_id", "favorites", "comments", "score"],
+            select(literal(name), club_activity.c.club_id, favorites, comments, favorites * FAVORITE_WEIGHT + comments)
+            .where(club_activity.c.bucket >= start)
+            .group_by(club_activity.c.club_id)
+        ))
+    bump("trending")
+
+
+# Compacts the windows before the decorated view runs (and before its ETag is computed) if the hour has
+# changed since this process last did, so rankings stay right when compact-trending isn't run on time.
+def compact_first(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        bucket = current_bucket()
+        if compacted["bucket"] != bucket:
+            # A compaction that lost the claim to another one still holds the write transaction.
+            if compact_trending(bucket):
+                db.session.commit()
+            else:
+                db.session.rollback()
+            compacted["bucket"] = bucket
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+# The limit clubs with the highest score in the window, highest first, as club dictionaries with an
+# "activity" dictionary of the window's favorites, comments and score.
+def trending_clubs(window, limit):
+    rows = db.session.execute(
+        select(trending_score.c.club_id, trending_score.c.favorites, trending_score.c.comments, trending_score.c.score)
+        .where(trending_score.c.window_name == window, trending_score.c.score > 0)
+        .order_by(trending_score.c.score.desc(), trending_score.c.club_id)
+        .limit(limit)
+    ).all()
+    clubs = {club.id: club for club in clubs_by_id([row.club_id for row in rows])}
+    return [
+        {**clubs[row.club_id].to_dict(),
+         "activity": {"favorites": row.favorites, "comments": row.comments, "score": row.score}}
+        for row in rows if row.club_id in clubs
+    ]
+
+
+# Parses the window= parameter of the trending endpoint. Raises ValueError with a user-facing message
+# if it isn't one of WINDOWS.
+def parse_window(args):
+    window = args.get("window", DEFAULT_WINDOW)
+    if window not in WINDOWS:
+        raise ValueError(f"window must be one of {', '.join(WINDOWS)}")
+    return window
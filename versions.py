@@ -0,0 +1,72 @@
+import time
+import zlib
+from functools import wraps
+
+from flask import current_app, make_response, request
+from sqlalchemy import insert, select, update
+
+from db import db
+from models import table_version
+from queries import wants_ndjson
+
+# Per-table version counters used for conditional GETs.
+# Every write endpoint bumps the counters of the tables it changes, inside its own transaction.
+# Read endpoints are decorated with @conditional(...) naming the tables their response is built from;
+# their ETag is made of those tables' versions and a checksum of the request path, so it can be checked against If-None-Match with a
+# single primary key lookup before the view runs, and a 304 is returned without loading any models.
+
+# "favorites" is bumped by favoriting and unfavoriting, which only change the clubs' favorite counts, so
+# responses that don't show them (like /api/tags) keep their ETag.
+TABLES = ("club", "tag", "user", "comments", "trending", "favorites")
+
+
+# Creates any missing counter rows. Counters start at the current time in milliseconds rather than 0,
+# so a freshly recreated database never hands out an ETag that a client cached from the old one.
+def create_versions():
+    existing = set(db.session.execute(select(table_version.c.name)).scalars())
+    seed = int(time.time() * 1000)
+    missing = [{"name": name, "version": seed} for name in TABLES if name not in existing]
+    if missing:
+        db.session.execute(insert(table_version), missing)
+    db.session.commit()
+
+
+def current_versions(tables):
+    rows = db.session.execute(
+        select(table_version.c.name, table_version.c.version).where(table_version.c.name.in_(tables))
+    ).all()
+    versions = dict(rows)
+    return [versions.get(name, 0) for name in tables]
+
+
+# Increments the version of each given table. Does not commit, so the bump becomes visible
+# together with the write it describes.
+def bump(*tables):
+    db.session.execute(
+        update(table_version).where(table_version.c.name.in_(tables)).values(version=table_version.c.version + 1)
+    )
+
+
+# Adds a strong ETag built from the given tables' versions to successful responses of the decorated view,
+# and answers 304 Not Modified when the request's If-None-Match already has it.
+def conditional(*tables):
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            versions = "-".join(str(version) for version in current_versions(tables))
+            etag = f"{versions}-{zlib.crc32(request.full_path.encode()):08x}"
+            if wants_ndjson():
+                etag += "-ndjson"
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return decorated
+
+    return decorator